@@ -1,12 +1,13 @@
 import numpy as np
-from numba import njit
+from numba import njit, prange, get_num_threads, set_num_threads
 import cv2
 import edt
-from scipy.ndimage import binary_dilation, binary_opening, binary_closing, label # I need to test against skimage labelling
+from scipy.ndimage import binary_opening, binary_closing, label # I need to test against skimage labelling
 from sklearn.utils.extmath import cartesian
 import fastremap
 import os, tifffile
-import time
+import time, math
+import functools, multiprocessing
 import mgen #ND rotation matrix
 from . import utils
 
@@ -55,6 +56,28 @@ try:
 except:
     HDBSCAN_ENABLED = False
     
+# GPU arrays, needed by the optional GPU backends below
+try:
+    import cupy
+    CUPY_ENABLED = True
+except:
+    CUPY_ENABLED = False
+    
+# GPU distance transform (PBA+), optional
+try:
+    from cucim.core.operations.morphology import distance_transform_edt as distance_transform_edt_gpu
+    CUCIM_ENABLED = CUPY_ENABLED
+except:
+    CUCIM_ENABLED = False
+    
+# GPU DBSCAN, optional
+try:
+    from cuml.cluster import DBSCAN as DBSCAN_GPU
+    from cuml.neighbors import NearestNeighbors as NearestNeighbors_GPU
+    CUML_ENABLED = CUPY_ENABLED
+except:
+    CUML_ENABLED = False
+
 import logging, sys
 logging.basicConfig(
                     level=logging.INFO,
@@ -73,10 +96,10 @@ omnipose_logger = logging.getLogger(__name__)
 # Several '#'s denote locations where code needs to be changed if a remerger ever happens 
 OMNI_INSTALLED = True
 
-from tqdm import trange 
+from tqdm import tqdm
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import ncolor, scipy
-from scipy.ndimage.filters import maximum_filter1d
-from scipy.ndimage import find_objects, gaussian_filter, generate_binary_structure, label, maximum_filter1d, binary_fill_holes, zoom
+from scipy.ndimage import find_objects, gaussian_filter, generate_binary_structure, label, maximum_filter, binary_fill_holes, zoom
 
     
 # try:
@@ -100,7 +123,11 @@ from skimage import filters
 import skimage.io #for debugging only
 SKIMAGE_ENABLED = True
 
-from scipy.ndimage import convolve, mean
+# remove_small_holes(ar, area_threshold) fills holes smaller than the threshold before skimage 0.26 
+# and holes up to that size from 0.26 on; the numba hole filling matches the installed one 
+_HOLES_INCLUSIVE = tuple(int(v) for v in skimage.__version__.split('.')[:2]) >= (0,26)
+
+from scipy.ndimage import convolve
 
 
 ### Section I: core utilities
@@ -152,7 +179,100 @@ def dist_to_diam(dt_pos,n):
     return 2*(n+1)*np.mean(dt_pos)
 #     return np.exp(3/2)*gmean(dt_pos[dt_pos>=gmean(dt_pos)])
 
-def diameters(masks, dt=None, dist_threshold=0):
+@functools.lru_cache(maxsize=8)
+def get_neighborhood(d, batch=0):
+    """ Steps to the 3**d pixels of the ND hypercube neighborhood, grouped by the kind of m-face 
+    each one shares with the central pixel. This only depends on the dimension, so it is cached 
+    (callers should not modify the returned arrays in place).
+
+    Parameters
+    --------------
+    d: int
+        number of spatial dimensions
+    batch: int
+        number of leading batch axes (steps along these are always zero)
+
+    Returns
+    --------------
+    steps: int, 2D array
+        <3**d> x <batch+d> array of steps, the central pixel is at index (3**d)//2
+    inds: list of int arrays
+        indices into steps for each hypercube group, e.g. in 2D: [4], [1,3,5,7], [0,2,6,8]
+    fact: float, 1D array
+        weighting factor for each hypercube group
+
+    """
+    neigh = [[0]]*batch+[[-1,0,1] for i in range(d)] # never step along the batch axis 
+    steps = cartesian(neigh) # all the possible step sequences in ND
+    # get indices of the hupercubes sharing m-faces on the central n-cube
+    sign = np.sum(np.abs(steps),axis=1) # signature distinguishing each kind of m-face via the number of steps 
+    uniq = fastremap.unique(sign)
+    inds = [np.where(sign==i)[0] for i in uniq] # 2D: [4], [1,3,5,7], [0,2,6,8]. 1-7 are y axis, 3-5 are x, etc. 
+    fact = np.sqrt(uniq) # weighting factor for each hypercube group 
+    return steps, inds, fact
+
+def labels_touch(masks):
+    """
+    Check if any two distinct labels are adjacent (sharing a face, edge, or corner).
+    Only uses slicing and elementwise logic, so it works on numpy and cupy arrays alike.
+
+    Parameters
+    --------------
+    masks: ND array, int
+        label matrix 0,...,N
+
+    Returns
+    --------------
+    touch: bool
+        True if any pixel has a neighbor with a different, nonzero label
+
+    """
+    d = masks.ndim
+    steps = get_neighborhood(d)[0]
+    # the second half of the steps are just the first half reversed, and the middle one is the center pixel
+    for step in steps[:len(steps)//2]:
+        source = tuple([slice(max(0,-s),L-max(0,s)) for s,L in zip(step,masks.shape)])
+        target = tuple([slice(max(0,s),L-max(0,-s)) for s,L in zip(step,masks.shape)])
+        a, b = masks[source], masks[target]
+        if ((a!=b) & (a>0) & (b>0)).any():
+            return True
+    return False
+
+def distance_transform(masks, use_gpu=False, parallel=1):
+    """
+    Euclidean distance transform of a label matrix. Each label is treated as its own region,
+    so pixels touching another label are treated like pixels touching the background (same as edt.edt).
+
+    On GPU, cuCIM (PBA+) is used if it is installed. That is a binary transform, so it is only
+    exact when no two labels touch; we otherwise fall back to edt. The same goes for the
+    OpenCV transform used for 2D label matrices on CPU.
+
+    Parameters
+    --------------
+    masks: ND array, int
+        label matrix 0,...,N
+    use_gpu: bool
+        flag to use the cuCIM transform on GPU when available
+    parallel: int
+        number of threads used by edt
+
+    Returns
+    --------------
+    dt: ND array, float
+        distance field
+
+    """
+    if use_gpu and CUCIM_ENABLED:
+        masks_gpu = cupy.asarray(masks)
+        if not labels_touch(masks_gpu):
+            return cupy.asnumpy(distance_transform_edt_gpu(masks_gpu>0))
+    # OpenCV needs some background to measure from (it returns 2**64 instead of inf otherwise).
+    # Looping OpenCV over each label is slower than edt, so touching labels still go to edt.
+    if masks.ndim==2 and not np.all(masks) and not labels_touch(masks):
+        return cv2.distanceTransform((masks>0).astype(np.uint8), cv2.DIST_L2, cv2.DIST_MASK_PRECISE)
+    return edt.edt(masks,parallel=parallel)
+
+def diameters(masks, dt=None, dist_threshold=0, use_gpu=False):
     
     """
     Calculate the mean cell diameter from a label matrix. 
@@ -165,6 +285,8 @@ def diameters(masks, dt=None, dist_threshold=0):
         distance field
     dist_threshold: float
         cutoff below which all values in dt are set to 0. Must be >=0. 
+    use_gpu: bool
+        flag to compute the distance field on GPU (if dt is not given)
         
     Returns
     --------------
@@ -176,10 +298,13 @@ def diameters(masks, dt=None, dist_threshold=0):
         dist_threshold = 0
     
     if dt is None and np.any(masks):
-        dt = edt.edt(np.int32(masks))
-    dt_pos = np.abs(dt[dt>dist_threshold])
+        # edt handles any integer type, so only non-integer labels need a cast (and a copy)
+        if not np.issubdtype(masks.dtype,np.integer):
+            masks = masks.astype(np.int32)
+        dt = distance_transform(masks,use_gpu=use_gpu)
+    dt_pos = dt[dt>dist_threshold] # threshold is nonnegative, so these are already positive
     if np.any(dt_pos):
-        diam = dist_to_diam(np.abs(dt_pos),n=masks.ndim)
+        diam = dist_to_diam(dt_pos,n=masks.ndim)
     else:
         diam = 0
     return diam
@@ -189,6 +314,16 @@ def diameters(masks, dt=None, dist_threshold=0):
 # It is possible that flows can be eliminated in place of the distance field. The current distance field may not be smooth 
 # enough, or maybe the network really does require the flow field prediction to work well. But in 3D, it will be a huge
 # advantage if the network could predict just the distance (and boudnary) classes and not 3 extra flow components. 
+# threads for the edt distance transform in masks_to_flows (the flow workers run it single-threaded)
+EDT_PARALLEL = 8
+
+def _flow_worker_init():
+    # each worker gets one core, so keep torch, numba and edt from spawning a thread per core in every process
+    global EDT_PARALLEL
+    EDT_PARALLEL = 1
+    torch.set_num_threads(1)
+    set_num_threads(1)
+
 def labels_to_flows(labels, files=None, use_gpu=False, device=None, omni=True, redo_flows=False, dim=2):
     """ Convert labels (list of masks or flows) to flows for training model.
 
@@ -222,6 +357,12 @@ def labels_to_flows(labels, files=None, use_gpu=False, device=None, omni=True, r
         flows[k][0] is labels[k], flows[k][1] is cell distance transform, flows[k][2:2+dim] are the 
         (T)YX flow components, and flows[k][-1] is heat distribution / smooth distance 
 
+    Notes
+    --------------
+    On CPU the flows are computed in a pool of spawned worker processes, so a script calling this 
+    function must do so under ``if __name__ == '__main__':``, otherwise every worker re-runs the 
+    script on import. 
+
     """
     
     
@@ -232,28 +373,45 @@ def labels_to_flows(labels, files=None, use_gpu=False, device=None, omni=True, r
         
         omnipose_logger.info('NOTE: computing flows for labels (could be done before to save time)')
         
-        # compute flows; labels are fixed in masks_to_flows, so they need to be passed back
-        labels, dist, heat, veci = map(list,zip(*[masks_to_flows(labels[n],use_gpu=use_gpu, 
-                                                                 device=device, omni=omni, dim=dim) 
-                                                  for n in trange(nimg)])) 
-        
-        # concatenate labels, distance transform, vector flows, heat (boundary and mask are computed in augmentations)
-        if omni and OMNI_INSTALLED:
-            flows = [np.concatenate((labels[n][np.newaxis,:,:], 
-                                     dist[n][np.newaxis,:,:], 
-                                     veci[n], 
-                                     heat[n][np.newaxis,:,:]), axis=0).astype(np.float32)
-                        for n in range(nimg)] 
-            # clean this up to swap heat and flowd and simplify code? would have to rerun all flow generation 
-        else:
-            flows = [np.concatenate((labels[n][np.newaxis,:,:], 
-                                     labels[n][np.newaxis,:,:]>0.5, 
-                                     veci[n]), axis=0).astype(np.float32)
-                    for n in range(nimg)]
-        if files is not None:
-            for flow, file in zip(flows, files):
-                file_name = os.path.splitext(file)[0]
-                tifffile.imsave(file_name+'_flows.tif', flow)
+        # compute flows; labels are fixed in masks_to_flows, so they need to be passed back.
+        # Images are independent, so on CPU they are spread over a pool of processes (GPU work stays here). 
+        kwargs = dict(use_gpu=use_gpu, device=device, omni=omni, dim=dim)
+        pool = None
+        try:
+            if use_gpu or nimg==1 or os.cpu_count()==1:
+                results = (masks_to_flows(labels[n],**kwargs) for n in range(nimg))
+            else:
+                # spawned, not forked: a fork after numba's TBB threading layer has started leaves this process hanging at exit 
+                pool = ProcessPoolExecutor(max_workers=min(nimg,os.cpu_count()), initializer=_flow_worker_init,
+                                           mp_context=multiprocessing.get_context('spawn'))
+                results = pool.map(functools.partial(masks_to_flows,**kwargs), labels)
+            
+            # concatenate labels, distance transform, vector flows, heat (boundary and mask are computed in augmentations)
+            # and write each one out in the background while the next one is computed 
+            flows = []
+            saved = []
+            with ThreadPoolExecutor(max_workers=1) as saver:
+                for n,(lbl, dist, heat, veci) in enumerate(tqdm(results,total=nimg)):
+                    if omni and OMNI_INSTALLED:
+                        flow = np.concatenate((lbl[np.newaxis,:,:], 
+                                               dist[np.newaxis,:,:], 
+                                               veci, 
+                                               heat[np.newaxis,:,:]), axis=0).astype(np.float32)
+                        # clean this up to swap heat and flowd and simplify code? would have to rerun all flow generation 
+                    else:
+                        flow = np.concatenate((lbl[np.newaxis,:,:], 
+                                               lbl[np.newaxis,:,:]>0.5, 
+                                               veci), axis=0).astype(np.float32)
+                    flows.append(flow)
+                    if files is not None:
+                        file_name = os.path.splitext(files[n])[0]
+                        saved.append(saver.submit(tifffile.imwrite, file_name+'_flows.tif', flow))
+                # raise any failed write (disk full, bad path...) instead of leaving stale flow files 
+                for future in saved:
+                    future.result()
+        finally:
+            if pool is not None:
+                pool.shutdown()
     else:
         omnipose_logger.info('flows precomputed (in omnipose.core now)') 
         flows = [labels[n].astype(np.float32) for n in range(nimg)]
@@ -300,7 +458,7 @@ def masks_to_flows(masks, dists=None, use_gpu=False, device=None, omni=True, dim
 
     if dists is None:
         masks = ncolor.format_labels(masks)
-        dists = edt.edt(masks,parallel=8)
+        dists = distance_transform(masks,use_gpu=use_gpu,parallel=EDT_PARALLEL)
         
     if device is None:
         if use_gpu:
@@ -314,17 +472,12 @@ def masks_to_flows(masks, dists=None, use_gpu=False, device=None, omni=True, dim
     
     if masks.ndim==3 and dim==2:
         # this branch preserves original 3D apprach 
-        Lz, Ly, Lx = masks.shape
-        mu = np.zeros((3, Lz, Ly, Lx), np.float32)
-        for z in range(Lz):
-            mu0 = masks_to_flows_device(masks[z], dists[z], device=device, omni=omni)[0]
-            mu[[1,2], z] += mu0
-        for y in range(Ly):
-            mu0 = masks_to_flows_device(masks[:,y], dists[:,y], device=device, omni=omni)[0]
-            mu[[0,2], :, y] += mu0
-        for x in range(Lx):
-            mu0 = masks_to_flows_device(masks[:,:,x], dists[:,:,x], device=device, omni=omni)[0]
-            mu[[0,1], :, :, x] += mu0
+        # all the slices along each axis are run as a single batch instead of one slice at a time 
+        mu = np.zeros((3,)+masks.shape, np.float32)
+        for ax in range(3):
+            mu0 = masks_to_flows_device(np.moveaxis(masks,ax,0), np.moveaxis(dists,ax,0), 
+                                        device=device, omni=omni, batch=True)[0]
+            mu[[i for i in range(3) if i!=ax]] += np.moveaxis(mu0,1,ax+1) # (2,Lz,Ly,Lx) after moving the batch axis back
         return masks, dists, None, mu #consistency with below
     
     else:
@@ -349,7 +502,7 @@ def masks_to_flows(masks, dists=None, use_gpu=False, device=None, omni=True, dim
 
 
 #Now fully converted to work for ND.
-def masks_to_flows_torch(masks, dists, device=None, omni=True):
+def masks_to_flows_torch(masks, dists, device=None, omni=True, batch=False):
     """Convert ND masks to flows. 
     
     Omnipose find distance field, Cellpose uses diffusion from center of mass.
@@ -365,12 +518,15 @@ def masks_to_flows_torch(masks, dists, device=None, omni=True):
         what compute hardware to use to run the code (GPU VS CPU)
     omni: bool
         flag to generate Omnipose flows instead of Cellpose flows
+    batch: bool
+        flag to treat the first axis of masks (and dists) as a stack of independent images
 
     Returns
     -------------
     mu: float, 3D or 4D array 
         flows in Y = mu[-2], flows in X = mu[-1].
         if masks are 3D, flows in Z or T = mu[0].
+        with batch, the batch axis comes right after the component axis. 
     dist: float, 2D or 3D array
         scalar field representing temperature distribution (Cellpose)
         or the smooth distance field (Omnipose)
@@ -379,52 +535,70 @@ def masks_to_flows_torch(masks, dists, device=None, omni=True):
     
     if device is None:
         device = torch.device('cuda')
+    d = masks.ndim - batch # number of spatial dimensions 
     if np.any(masks):
         # the padding here is different than the padding added in masks_to_flows(); 
         # for omni, we reflect masks to extend skeletons to the boundary. Here we pad 
         # with 0 to ensure that edge pixels are not handled differently. 
+        # The labels are uploaded once and padded on the device, the host only needs them unpadded. 
         pad = 1
-        masks_padded = np.pad(masks,pad)
+        masks_padded = torch.from_numpy(masks.astype(np.int32,copy=False)).to(device)
+        masks_padded = torch.nn.functional.pad(masks_padded,(pad,)*2*d) # nothing to pad along the batch axis
 
         centers = np.array([])
         if not omni: #do original centroid projection algrorithm
-            # get mask centers
-            centers = np.array(scipy.ndimage.center_of_mass(masks_padded, labels=masks_padded, 
-                                                            index=np.arange(1, masks_padded.max()+1))).astype(int).T
+            labels = masks
+            if batch: # the same label can show up in several images, so give each (image, label) pair its own label
+                offset = np.arange(masks.shape[0]).reshape((-1,)+(1,)*d)*(masks.max()+1)
+                labels = fastremap.renumber((masks+offset)*(masks>0))[0]
+            # get mask centers, all at once with bincount rather than per label 
+            coords = np.nonzero(labels)
+            lbl = labels[coords]-1
+            counts = np.bincount(lbl, minlength=labels.max())
+            centers = np.stack([np.bincount(lbl, weights=c, minlength=labels.max())/counts for c in coords]).astype(int)
             # (check mask center inside mask)
-            valid = masks_padded[tuple(centers)] == np.arange(1, masks_padded.max()+1)
+            valid = labels[tuple(centers)] == np.arange(1, labels.max()+1)
             for i in np.nonzero(~valid)[0]:
-                coords = np.array(np.nonzero(masks_padded==(i+1)))
-                meds = np.median(coords,axis=0)
-                imin = np.argmin(np.sum((coords-meds)**2,axis=0))
+                coords = np.array(np.nonzero(labels==(i+1)))
+                meds = np.median(coords[batch:],axis=0) # spatial coordinates only 
+                imin = np.argmin(np.sum((coords[batch:]-meds)**2,axis=0))
                 centers[:,i]=coords[:,imin]
+            centers[batch:] += pad # shift into the padded array
 
-        # set number of iterations
+        # set number of iterations, one per image for a batch 
         if omni and OMNI_INSTALLED:
             # omni version requires fewer iterations 
-            n_iter = get_niter(dists) ##### omnipose.core.get_niter
+            n_iter = [get_niter(dist) for dist in (dists if batch else [dists])] ##### omnipose.core.get_niter
         else:
-            slices = scipy.ndimage.find_objects(masks)
-            ext = np.array([[s.stop - s.start + 1 for s in slc] for slc in slices])
-            n_iter = 2 * (ext.sum(axis=1)).max()
-
+            n_iter = []
+            for m in (masks if batch else [masks]):
+                slices = [slc for slc in scipy.ndimage.find_objects(m) if slc is not None]
+                ext = np.array([[s.stop - s.start + 1 for s in slc] for slc in slices])
+                n_iter.append(2 * (ext.sum(axis=1)).max() if len(slices) else 0)
+        if not batch:
+            n_iter = n_iter[0]
 
         # run diffusion 
-        mu, T = _extend_centers_torch(masks_padded, centers, n_iter=n_iter, device=device, omni=omni)
+        mu, T = _extend_centers_torch(masks_padded, centers, n_iter=n_iter, device=device, omni=omni, batch=batch)
         # normalize
         mu = utils.normalize_field(mu) ##### transforms.normalize_field(mu,omni)
 
         # put into original image
         mu0 = np.zeros((mu.shape[0],)+masks.shape)
         mu0[(Ellipsis,)+np.nonzero(masks)] = mu
-        unpad =  tuple([slice(pad,-pad)]*masks.ndim)
+        unpad =  tuple([slice(None)]*batch+[slice(pad,-pad)]*d)
         dist = T[unpad] # mu_c now heat/distance
         return mu0, dist
     else:
-        return np.zeros((masks.ndim,)+masks.shape),np.zeros(masks.shape)
+        return np.zeros((d,)+masks.shape),np.zeros(masks.shape)
 
 # edited slightly to fix a 'bleeding' issue with the gradient; now identical to CPU version
-def _extend_centers_torch(masks, centers, n_iter=200, device=torch.device('cuda'), omni=True):
+# shifted-view (whole array) diffusion is only faster than gathering the mask pixels for densely packed images 
+DENSE_FILL = 0.7
+# replay the diffusion iterations from a captured CUDA graph; opt-in, set omnipose.core.CUDA_GRAPH = True to use it 
+CUDA_GRAPH = False
+
+def _extend_centers_torch(masks, centers, n_iter=200, device=torch.device('cuda'), omni=True, batch=False):
     """ runs diffusion on GPU to generate flows for training images or quality control
     PyTorch implementation is faster than jitted CPU implementation, therefore only the 
     GPU optimized code is being used moving forward. 
@@ -432,17 +606,19 @@ def _extend_centers_torch(masks, centers, n_iter=200, device=torch.device('cuda'
     Parameters
     -------------
 
-    masks: int, 2D or 3D array
-        labelled masks 0=NO masks; 1,2,...=mask labels
+    masks: int, 2D or 3D array or tensor
+        labelled masks 0=NO masks; 1,2,...=mask labels, padded by 1 with zeros
     centers: int, 2D or 3D array
         array of center coordinates [[y0,x0],[x1,y1],...] or [[t0,y0,x0],...]
     n_inter: int
-        number of iterations
+        number of iterations (list with one per image for a batch)
     device: torch device
         what compute hardware to use to run the code (GPU VS CPU)  
     omni: bool
         whether to generate Omnipose field (solve Eikonal equation) 
         or the Cellpose field (solve heat equation from "center") 
+    batch: bool
+        whether the first axis of masks is a stack of independent images
         
     Returns
     -------------
@@ -455,56 +631,123 @@ def _extend_centers_torch(masks, centers, n_iter=200, device=torch.device('cuda'
          
     """
         
-    d = masks.ndim
-    coords = np.nonzero(masks)
+    d = masks.ndim - batch # number of spatial dimensions
     idx = (3**d)//2 # center pixel index
-
-    neigh = [[-1,0,1] for i in range(d)]
-    steps = cartesian(neigh) # all the possible step sequences in ND
-    neighbors = np.array([np.add.outer(coords[i],steps[:,i]) for i in range(d)]).swapaxes(-1,-2)
-    
-    # get indices of the hupercubes sharing m-faces on the central n-cube
-    sign = np.sum(np.abs(steps),axis=1) # signature distinguishing each kind of m-face via the number of steps 
-    uniq = fastremap.unique(sign)
-    inds = [np.where(sign==i)[0] for i in uniq] # 2D: [4], [1,3,5,7], [0,2,6,8]. 1-7 are y axis, 3-5 are x, etc. 
-    fact = np.sqrt(uniq) # weighting factor for each hypercube group 
-    
-    # get neighbor validator (not all neighbors are in same mask)
-    neighbor_masks = masks[tuple(neighbors)] #extract list of label values, 
-    isneighbor = neighbor_masks == neighbor_masks[idx] 
-    
-    nimg = neighbors.shape[1] // (3**d)
-    pt = torch.from_numpy(neighbors).to(device)
-    T = torch.zeros((nimg,)+masks.shape, dtype=torch.float, device=device)
-    isneigh = torch.from_numpy(isneighbor).to(device) # isneigh is <3**d> x <number of points in mask>
+    steps, inds, fact = get_neighborhood(d,batch) 
+    
+    if not torch.is_tensor(masks):
+        masks = torch.from_numpy(masks.astype(np.int32,copy=False))
+    masks = masks.to(device)
+    
+    # Sparse images (the usual case: background, isolated cells, volumes) gather the neighbors of the 
+    # mask pixels on each iteration. Densely packed images instead update the whole array at once: 
+    # the masks are padded, so every mask pixel lies in the interior and its neighbors along a given 
+    # step are just a shifted view of the interior. That skips the gathers, but it also updates the 
+    # background, so it only pays off when most of the image is mask. 
+    interior = (Ellipsis,)+tuple([slice(None)]*batch+[slice(1,s-1) for s in masks.shape[batch:]])
+    inmask = masks[interior]>0
+    dense = inmask.float().mean().item() >= DENSE_FILL
+    
+    T = torch.zeros((1,)+masks.shape, dtype=torch.float, device=device)
+    if dense:
+        shifted = [(Ellipsis,)+tuple([slice(1+k,s-1+k) if a>=batch else slice(None) 
+                                      for a,(k,s) in enumerate(zip(step,masks.shape))]) for step in steps]
+        # get neighbor validator (not all neighbors are in same mask)
+        isneigh = torch.stack([masks[shift]==masks[interior] for shift in shifted]) # <3**d> x <interior shape>
+        neigh = lambda T: torch.stack([T[shift] for shift in shifted],dim=1) # 1 x <3**d> x <interior shape>
+    else:
+        # flat indices of the mask pixels and of their neighbors in the padded array 
+        strides = torch.tensor(masks.stride(), device=device)
+        pix = torch.nonzero(masks.reshape(-1)>0).squeeze(1)
+        nbr = pix + (torch.from_numpy(steps).to(device) @ strides)[:,None] # <3**d> x <number of points in mask>
+        mflat = masks.reshape(-1)
+        isneigh = mflat[nbr]==mflat[pix]
+        Tflat = T.reshape(-1)
+        neigh = lambda T: Tflat[nbr][None] # 1 x <3**d> x <number of points in mask>
     
     meds = torch.from_numpy(centers.astype(int)).to(device)
-
-    mask_pix = (Ellipsis,)+tuple(pt[:,idx]) #indexing for the central coordinates 
     center_pix = (Ellipsis,)+tuple(meds)
-    neigh_pix = (Ellipsis,)+tuple(pt)    
-    for t in range(n_iter):
+    
+    # images in a batch need different numbers of iterations, so each image stops updating after it is done
+    if batch:
+        n_iter = np.array(n_iter)
+        niter_img = torch.from_numpy(n_iter).to(device)
+        niter_img = niter_img.reshape((1,-1)+(1,)*d) if dense else niter_img[pix//masks.stride(0)]
+        if not omni:
+            niter_center = torch.from_numpy(n_iter[centers[0]]).to(device)
+        n_iter = n_iter.max()
+        
+    # one iteration, T is updated in place; t can be an int or a tensor on the device
+    def step(t):
+        if not omni:
+            T[center_pix] += (t<niter_center) if batch else 1
+        Tneigh = neigh(T)
+        Tneigh *= isneigh  #zeros out any elements that do not belong in convolution
         if omni and OMNI_INSTALLED:
-             T[mask_pix] = eikonal_update_torch(T,pt,isneigh,d,inds,fact) ##### omnipose.core.eikonal_update_torch
+            Tnew = eikonal_update_neighbors_torch(Tneigh,d,inds,fact) ##### omnipose.core.eikonal_update_neighbors_torch
+        else:
+            Tnew = Tneigh.mean(axis=1) # mean along the <3**d>-element column does the box convolution 
+        if dense:
+            Tnew *= inmask # background stays at zero 
+            if batch:
+                Tnew = torch.where(t<niter_img, Tnew, T[interior])
+            T[interior] = Tnew
         else:
-            T[center_pix] += 1
-            Tneigh = T[neigh_pix] # T is square, but Tneigh is nimg x <3**d> x <number of points in mask>
-            Tneigh *= isneigh  #zeros out any elements that do not belong in convolution
-            T[mask_pix] = Tneigh.mean(axis=1) # mean along the <3**d>-element column does the box convolution 
+            Tnew = Tnew.reshape(-1)
+            if batch:
+                Tnew = torch.where(t<niter_img, Tnew, Tflat[pix])
+            Tflat[pix] = Tnew
+    
+    # Every iteration launches the same kernels on the same shapes, so on CUDA we can run a few warm-up 
+    # iterations and then capture one in a graph, replaying it for the rest instead of launching each 
+    # kernel from python. The iteration counter lives on the device so that the graph can advance it 
+    # (and the per-image t<niter_img test of a batch is part of the graph). Only used if CUDA_GRAPH is set. 
+    nwarm = 3
+    start = 0
+    graph = None
+    if CUDA_GRAPH and device.type=='cuda' and hasattr(torch.cuda,'graph') and n_iter>nwarm:
+        t = torch.zeros((),dtype=torch.long,device=device)
+        stream = torch.cuda.Stream(device)
+        stream.wait_stream(torch.cuda.current_stream(device))
+        with torch.cuda.stream(stream):
+            for i in range(nwarm):
+                step(t)
+                t += 1
+        torch.cuda.current_stream(device).wait_stream(stream)
+        start = nwarm
+        try:
+            graph = torch.cuda.CUDAGraph()
+            with torch.cuda.graph(graph):
+                step(t)
+                t += 1
+        except RuntimeError as e:
+            graph = None # capture not supported here, fall back to the plain loop
+            torch.cuda.synchronize(device)
+            omnipose_logger.info('CUDA graph capture failed, using the plain loop: {}'.format(e))
+        
+    if graph is not None:
+        for i in range(start,n_iter):
+            graph.replay()
+    else:
+        for t in range(start,n_iter):
+            step(t)
 
     # There is still a fade out effect on long cells, not enough iterations to diffuse far enough I think 
     # The log operation does not help much to alleviate it, would need a smaller constant inside. 
     if not omni:
         T = torch.log(1.+ T)
     
-    Tcpy = T.clone()
     idx = inds[1]
     mask = isneigh[idx]
-    cardinal_points = (Ellipsis,)+tuple(pt[:,idx]) 
-    grads = T[cardinal_points]*mask # prevent bleedover, big problem in stock Cellpose that got reverted! 
-    mu_torch = np.stack([(grads[:,-(i+1)]-grads[:,i]).cpu().squeeze() for i in range(0,grads.shape[1]//2)])/2
+    if dense:
+        grads = torch.stack([T[shifted[i]] for i in idx],dim=1)*mask # prevent bleedover, big problem in stock Cellpose that got reverted! 
+        grads = grads[(Ellipsis,)+tuple(torch.nonzero(inmask,as_tuple=True))][0] # back to <2*d> x <number of points in mask>
+    else:
+        grads = T.reshape(-1)[nbr[idx]]*mask
+    half = grads.shape[0]//2 # the second half of the cardinal points are the first half reversed 
+    mu_torch = ((grads[half:].flip(0)-grads[:half])/2).cpu().numpy() # one copy back to host 
 
-    return mu_torch, Tcpy.cpu().squeeze()
+    return mu_torch, T.cpu()[0]
 
 def eikonal_update_torch(T,pt,isneigh,d=None,index_list=None,factors=None):
     """Update for iterative solution of the eikonal equation on GPU."""
@@ -514,14 +757,20 @@ def eikonal_update_torch(T,pt,isneigh,d=None,index_list=None,factors=None):
     
     Tneigh = T[(Ellipsis,)+tuple(pt)]
     Tneigh *= isneigh
+    return eikonal_update_neighbors_torch(Tneigh,d,index_list,factors)
+
+def eikonal_update_neighbors_torch(Tneigh,d=None,index_list=None,factors=None):
+    """Eikonal update from the array of neighbor values (nimg x <3**d> x ...), 
+    non-neighbor elements already zeroed out."""
+    update = update_torch_compiled if (TORCH_COMPILE and Tneigh.is_cuda) else update_torch
     # preallocate array to multiply into to do the geometric mean
-    phi_total = torch.ones_like(Tneigh[0,0,:])
+    phi_total = torch.ones_like(Tneigh[0,0])
     # loop over each index list + weight factor 
     for inds,fact in zip(index_list[1:],factors[1:]):
         # find the minimum of each hypercube pair along each axis
         mins = [torch.minimum(Tneigh[:,inds[i],:],Tneigh[:,inds[-(i+1)],:]) for i in range(len(inds)//2)] 
         #apply update rule using the array of mins
-        phi = update_torch(torch.cat(mins),fact)
+        phi = update(torch.cat(mins),fact)
         # multipy into storage array
         phi_total *= phi    
     return phi_total**(1/d) #geometric mean of update along each connectivity set 
@@ -542,10 +791,32 @@ def update_torch(a,f):
     radicand = sum_a**2-d*(sum_a2-f**2)
     mask = radicand>=0
     d = torch.count_nonzero(mask,dim=0)
-    r = torch.arange(0,a.shape[-1])
-    ad = sum_a[d-1,r]
-    rd = radicand[d-1,r]
-    return (1/d)*(ad+torch.sqrt(rd))
+    # pick out the largest valid upper limit; gather works for a of any shape (dense or flattened pixels)
+    ad = torch.gather(sum_a,0,(d-1).unsqueeze(0)).squeeze(0)
+    rd = torch.gather(radicand,0,(d-1).unsqueeze(0)).squeeze(0)
+    return (1/d)*(ad+torch.sqrt(rd.clamp_min(0))) # clamp absorbs float32 rounding in the radicand
+
+# update_torch is a chain of small elementwise ops that run every iteration, so on GPU it can be worth
+# compiling once per process to fuse them (shapes vary between images, hence dynamic). The first compile 
+# takes tens of seconds, so it is opt-in: set omnipose.core.TORCH_COMPILE = True to use it. 
+# On CPU, or if compiling is not possible, the eager version is used. 
+TORCH_COMPILE = False
+_update_torch_compiled = None
+
+def update_torch_compiled(a,f):
+    """Fused (torch.compile) version of update_torch, falls back to update_torch."""
+    global _update_torch_compiled
+    if _update_torch_compiled is None:
+        _update_torch_compiled = update_torch
+        if hasattr(torch,'compile'):
+            compiled = torch.compile(update_torch, dynamic=True)
+            try:
+                phi = compiled(a,f)
+                _update_torch_compiled = compiled
+                return phi
+            except Exception as e:
+                omnipose_logger.info('torch.compile failed for update_torch, using eager version: {}'.format(e))
+    return _update_torch_compiled(a,f)
 
 
 ### Section II: mask recontruction
@@ -556,7 +827,7 @@ def compute_masks(dP, dist, bd=None, p=None, inds=None, niter=200, rescale=1.0,
                   mask_threshold=0.0, diam_threshold=12.,flow_threshold=0.4, 
                   interp=True, cluster=False, do_3D=False, min_size=None, omni=True, 
                   calc_trace=False, verbose=False, use_gpu=False, device=None, nclasses=3, 
-                  dim=2, eps=None, hdbscan=False, flow_factor=6, debug=False):
+                  dim=2, eps=None, hdbscan=False, flow_factor=6, debug=False, half=False):
     """
     Compute masks using dynamics from dP, dist, and boundary outputs.
     
@@ -613,6 +884,8 @@ def compute_masks(dP, dist, bd=None, p=None, inds=None, niter=200, rescale=1.0,
         multiple to increase flow magnitdue (used in 3D only, experimental)
     debug:
         option to return list of unique mask labels as a fourth output (for debugging only)
+    half: bool
+        sample the flow field in float16 during interpolated dynamics on CUDA (faster, less precise)
 
     Returns
     -------------
@@ -680,7 +953,7 @@ def compute_masks(dP, dist, bd=None, p=None, inds=None, niter=200, rescale=1.0,
             # dP_ = dP.copy()
             if dim>2:
                 dP_ *= flow_factor
-                print('dP_ times {} for >2d, still experimenting'.format(flow_factor))
+                omnipose_logger.debug('dP_ times %s for >2d, still experimenting', flow_factor)
 
         else:
             dP_ = dP * mask / 5.
@@ -689,7 +962,7 @@ def compute_masks(dP, dist, bd=None, p=None, inds=None, niter=200, rescale=1.0,
         if p is None:
             p, inds, tr = follow_flows(dP_, inds, niter=niter, interp=interp,
                                        use_gpu=use_gpu, device=device, omni=omni,
-                                       calc_trace=calc_trace, verbose=verbose)
+                                       calc_trace=calc_trace, verbose=verbose, half=half)
         else:
             tr = []
             inds = np.stack(np.nonzero(mask))
@@ -700,17 +973,16 @@ def compute_masks(dP, dist, bd=None, p=None, inds=None, niter=200, rescale=1.0,
         if omni and OMNI_INSTALLED:
             mask, labels = get_masks(p, bd, dist, mask, inds,nclasses, cluster=cluster,
                                      diam_threshold=diam_threshold, verbose=verbose, 
-                                     eps=eps, hdbscan=hdbscan) ##### omnipose.core.get_masks
+                                     eps=eps, hdbscan=hdbscan, use_gpu=use_gpu) ##### omnipose.core.get_masks
         else:
             mask = get_masks_cp(p, iscell=mask, flows=dP, use_gpu=use_gpu) ### just get_masks
         # flow thresholding factored out of get_masks
         if not do_3D: 
-            shape0 = p.shape[1:]
             flows = dP
             if mask.max()>0 and flow_threshold is not None and flow_threshold > 0 and flows is not None:
                 mask = remove_bad_flow_masks(mask, flows, threshold=flow_threshold, use_gpu=use_gpu, device=device, omni=omni)
-                _,mask = np.unique(mask, return_inverse=True)
-                mask = np.reshape(mask, shape0).astype(np.int32)
+                fastremap.renumber(mask,in_place=True) # O(N), no sort like np.unique
+                mask = mask.astype(np.int32,copy=False)
         
 
     else: # nothing to compute, just make it compatible
@@ -773,13 +1045,34 @@ def div_rescale(dP,mask):
         rescaled flow field
     
     """
-    dP = dP.copy()
-    dP *= mask 
-    dP = utils.normalize_field(dP)
+    # masking and normalization happen in one pass over the flattened field (instead of copy, 
+    # multiply, magnitude, divide), then the rescaling by the divergence is done in place 
+    d = dP.shape[0]
+    mask = np.ascontiguousarray(np.broadcast_to(mask,dP.shape[1:]))
+    out = np.empty(dP.shape,dtype=dP.dtype)
+    _masked_unit_field(np.ascontiguousarray(dP).reshape(d,-1),mask.reshape(-1),out.reshape(d,-1))
     # div = utils.normalize99(likewise(dP))
-    div = utils.normalize99(divergence(dP))
-    dP *= div
-    return dP
+    div = utils.normalize99(divergence(out))
+    out *= div
+    return out
+
+@njit(parallel=True)
+def _masked_unit_field(dP, mask, out):
+    # same as utils.normalize_field(dP*mask) on <d> x <number of pixels> arrays
+    d, n = dP.shape
+    for i in prange(n):
+        mag = out.dtype.type(0)
+        for c in range(d):
+            v = dP[c,i]*mask[i]
+            out[c,i] = v
+            if not np.isnan(v): # nansum
+                mag += v*v
+        mag = np.sqrt(mag)
+        for c in range(d):
+            if mag!=0 and not np.isnan(mag): # safe_divide
+                out[c,i] = out[c,i]/mag
+            else:
+                out[c,i] = 0
 
 def sigmoid(x):
     """The sigmoid function."""
@@ -805,11 +1098,66 @@ def divergence(f,sp=None):
         
     """
     num_dims = len(f)
+    # fused kernels write the sum in one pass instead of allocating a gradient array per axis
+    if num_dims in [2,3] and np.ndim(f)==num_dims+1 and min(f.shape[1:])>1:
+        f = np.asarray(f)
+        out = np.empty(f.shape[1:],dtype=np.result_type(f.dtype,np.float32))
+        if num_dims==2:
+            _divergence_2d(f[0],f[1],out)
+        else:
+            _divergence_3d(f[0],f[1],f[2],out)
+        return out
     return np.ufunc.reduce(np.add, [np.gradient(f[i], axis=i) for i in range(num_dims)])
 
+# same edge handling as np.gradient: central differences inside, one-sided at the ends
+@njit(parallel=True)
+def _divergence_2d(f0,f1,out):
+    n0,n1 = out.shape
+    for i in prange(n0):
+        for j in range(n1):
+            if i==0:
+                g0 = f0[1,j]-f0[0,j]
+            elif i==n0-1:
+                g0 = f0[n0-1,j]-f0[n0-2,j]
+            else:
+                g0 = (f0[i+1,j]-f0[i-1,j])/2
+            if j==0:
+                g1 = f1[i,1]-f1[i,0]
+            elif j==n1-1:
+                g1 = f1[i,n1-1]-f1[i,n1-2]
+            else:
+                g1 = (f1[i,j+1]-f1[i,j-1])/2
+            out[i,j] = g0+g1
+
+@njit(parallel=True)
+def _divergence_3d(f0,f1,f2,out):
+    n0,n1,n2 = out.shape
+    for i in prange(n0):
+        for j in range(n1):
+            for k in range(n2):
+                if i==0:
+                    g0 = f0[1,j,k]-f0[0,j,k]
+                elif i==n0-1:
+                    g0 = f0[n0-1,j,k]-f0[n0-2,j,k]
+                else:
+                    g0 = (f0[i+1,j,k]-f0[i-1,j,k])/2
+                if j==0:
+                    g1 = f1[i,1,k]-f1[i,0,k]
+                elif j==n1-1:
+                    g1 = f1[i,n1-1,k]-f1[i,n1-2,k]
+                else:
+                    g1 = (f1[i,j+1,k]-f1[i,j-1,k])/2
+                if k==0:
+                    g2 = f2[i,j,1]-f2[i,j,0]
+                elif k==n2-1:
+                    g2 = f2[i,j,n2-1]-f2[i,j,n2-2]
+                else:
+                    g2 = (f2[i,j,k+1]-f2[i,j,k-1])/2
+                out[i,j,k] = g0+g1+g2
+
 
 def get_masks(p, bd, dist, mask, inds, nclasses=4,cluster=False,
-              diam_threshold=12., eps=None, hdbscan=False, verbose=False):
+              diam_threshold=12., eps=None, hdbscan=False, verbose=False, use_gpu=False):
     """Omnipose mask recontruction algorithm.
     
     This function is called after dynamics are run. The final pixel coordinates are provided, 
@@ -841,6 +1189,8 @@ def get_masks(p, bd, dist, mask, inds, nclasses=4,cluster=False,
         use better, but much SLOWER, hdbscan clustering algorithm
     verbose: bool
         option to print more info to log file
+    use_gpu: bool
+        run DBSCAN and the outlier snapping on the GPU with cuML (if installed)
     
     Returns
     -------------
@@ -886,37 +1236,46 @@ def get_masks(p, bd, dist, mask, inds, nclasses=4,cluster=False,
             alg = ['','H']
             omnipose_logger.info('Doing {}DBSCAN clustering with eps={}'.format(alg[hdbscan],eps))
         
+        gpu = use_gpu and CUML_ENABLED and not (hdbscan and HDBSCAN_ENABLED)
         if hdbscan and HDBSCAN_ENABLED:
             clusterer = HDBSCAN(cluster_selection_epsilon=eps,
                                 # allow_single_cluster=True,
                                 min_samples=3)
+        elif gpu:
+            clusterer = DBSCAN_GPU(eps=eps, min_samples=5)
+            newinds_gpu = cupy.asarray(newinds)
         else:
             clusterer = DBSCAN(eps=eps, min_samples=5, n_jobs=-1)
         
-        clusterer.fit(newinds)
-        labels = clusterer.labels_
+        if gpu:
+            clusterer.fit(newinds_gpu)
+            labels = cupy.asnumpy(clusterer.labels_)
+        else:
+            clusterer.fit(newinds)
+            labels = clusterer.labels_
         executionTime = (time.time() - startTime)
         
         if verbose:
-            print('Execution time in seconds: ' + str(executionTime))
-            print('{} unique labels found'.format(len(np.unique(labels))-1),newinds.shape)
+            omnipose_logger.info('Execution time in seconds: %s', executionTime)
+            omnipose_logger.info('%d unique labels found %s', len(np.unique(labels))-1, newinds.shape)
 
         #### snapping outliers to nearest cluster 
         snap = 1
         if snap:
-            nearest_neighbors = NearestNeighbors(n_neighbors=50)
-            neighbors = nearest_neighbors.fit(newinds)
-            o_inds= np.where(labels==-1)[0]
-            if len(o_inds)>1:
-                outliers = [newinds[i] for i in o_inds]
-                distances, indices = neighbors.kneighbors(outliers)
-                # indices,o_inds
-
-                ns = labels[indices]
-                # if len(ns)>0:
-                l = [n[np.where(n!=-1)[0][0] if np.any(n!=-1) else 0] for n in ns]
-                # l = [n[(np.where(n!=-1)+(0,))[0][0] ] for n in ns]
-                labels[o_inds] = l
+            # fit only the clustered points, so the single nearest neighbor of each outlier gives its cluster
+            o_inds = np.where(labels==-1)[0]
+            c_inds = np.where(labels!=-1)[0]
+            if len(o_inds)>1 and len(c_inds):
+                if gpu:
+                    nearest_neighbors = NearestNeighbors_GPU(n_neighbors=1)
+                    neighbors = nearest_neighbors.fit(newinds_gpu[c_inds])
+                    distances, indices = neighbors.kneighbors(newinds_gpu[o_inds])
+                    indices = cupy.asnumpy(indices)
+                else:
+                    nearest_neighbors = NearestNeighbors(n_neighbors=1)
+                    neighbors = nearest_neighbors.fit(newinds[c_inds])
+                    distances, indices = neighbors.kneighbors(newinds[o_inds])
+                labels[o_inds] = labels[c_inds[indices[:,0]]]
 
         ###
         mask[cell_px] = labels+1 # outliers have label -1
@@ -927,11 +1286,8 @@ def get_masks(p, bd, dist, mask, inds, nclasses=4,cluster=False,
         skelmask[new_px] = 1
 
         #disconnect skeletons at the edge, 5 pixels in 
-        border_mask = np.zeros(skelmask.shape, dtype=bool)
-        border_px =  border_mask.copy()
-        border_mask = binary_dilation(border_mask, border_value=1, iterations=5)
-
-        border_px[border_mask] = skelmask[border_mask]
+        border_mask = utils.get_border_mask(skelmask.shape, 5)
+        border_px = skelmask & border_mask
         if verbose:
              omnipose_logger.info('nclasses: {}, mask.ndim: {}'.format(nclasses,mask.ndim))
         if nclasses == mask.ndim+2: #can use boundary to erase joined edge skelmasks 
@@ -960,17 +1316,31 @@ def get_masks(p, bd, dist, mask, inds, nclasses=4,cluster=False,
 # also should just rescale to desired resolution HERE instead of rescaling the masks later... <<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<
 # grid_sample will only work for up to 5D tensors (3D segmentation). Will have to address this shortcoming if we ever do 4D. 
 # I got rid of the map_coordinates branch, I tested execution times and pytorch implemtation seems as fast or faster
-def steps_interp(p, dP, niter, use_gpu=True, device=None, omni=True, calc_trace=False, calc_bd=False, verbose=False):
+def _to_device_pinned(x, device):
+    """ Copy a numpy array to a float32 tensor on device. CUDA copies go through pinned (page-locked) 
+    host memory, which is DMA'd faster and lets the copy run asynchronously: kernels queued after it on 
+    the same stream still wait for it, but the CPU can go on launching them in the meantime. 
+    """
+    x = torch.from_numpy(np.ascontiguousarray(x, dtype=np.float32))
+    if device.type == 'cuda':
+        return x.pin_memory().to(device, non_blocking=True)
+    return x.to(device)
+
+def steps_interp(p, dP, niter, use_gpu=True, device=None, omni=True, calc_trace=False, calc_bd=False, verbose=False, half=False):
     """Euler integration of pixel locations p subject to flow dP for niter steps in N dimensions. 
     
     Parameters
     ----------------
-    p: float32, ND array
+    p: float32, ND array or torch tensor
         pixel locations [axis x Lz x Ly x Lx] (start at initial meshgrid)
     dP: float32, ND array
         flows [axis x Lz x Ly x Lx]
     niter: int32
         number of iterations of dynamics to run
+    half: bool
+        on CUDA, sample the flow in float16 (opt-in). The positions are stepped in float32, but 
+        they are sampled at float16 coordinates, which resolve ~5e-4 of the [-1,1] range near its 
+        edges, i.e. about 0.5px at 2000px; only use this for small images. 
 
     Returns
     ---------------
@@ -1000,41 +1370,58 @@ def steps_interp(p, dP, niter, use_gpu=True, device=None, omni=True, calc_trace=
 
     # for grid_sample to work, we need im,pt to be (N,C,H,W),(N,H,W,2) or (N,C,D,H,W),(N,D,H,W,3). The 'image' getting interpolated
     # is the flow, which has d=2 channels in 2D and 3 in 3D (d vector components). Output has shape (N,C,H,W) or (N,C,D,H,W)
-    pt = torch.from_numpy(p[inds].T).float().to(device)
+    if torch.is_tensor(p):
+        pt = p[inds].T.float().to(device)
+    else:
+        pt = _to_device_pinned(p[inds].T, device)
     # print('pt shape',pt.shape)
     pt0 = pt.clone() # save first
     for k in range(d):
         pt = pt.unsqueeze(0) # get it in the right shape
-    flow = torch.from_numpy(dP[inds]).float().to(device).unsqueeze(0) #covert flow numpy array to tensor on GPU, add dimension 
+    flow = _to_device_pinned(dP[inds], device).unsqueeze(0) #covert flow numpy array to tensor on GPU, add dimension 
     # print('shapes',p.shape,dP.shape,pt.shape)
 
     # we want to normalize the coordinates between 0 and 1. To do this, 
     # we divide the coordinates by the shape along that dimension. To symmetrize,
     # we then multiply by 2 and subtract 1. I
     # We also need to rescale the flow by the same factor, but no shift of -1. 
-    
-    for k in range(d): 
-        pt[...,k] = 2*pt[...,k]/shape[k] - 1
-        flow[:,k] = 2*flow[:,k]/shape[k]
+    # The last axis of pt is the component axis, the second axis of flow is. 
+    shape_t = torch.from_numpy(shape).float().to(device)
+    pt = 2*pt/shape_t - 1
+    flow = 2*flow/shape_t.reshape((1,d)+(1,)*d)
+    
+    # grid_sample is bound by the memory traffic of gathering the flow, so optionally do it in float16 on CUDA. 
+    # Only the sampling is reduced: stepping the positions in float16 (or bfloat16) rounds away
+    # the small late steps and breaks up cells. The sample coordinates are still quantized, see above. 
+    half = half and device.type == 'cuda'
+    if half:
+        flow = flow.half()
+    def sample(pt):
+        if half:
+            return torch.nn.functional.grid_sample(flow, pt.half(), mode=mode, align_corners=align_corners).float()
+        return torch.nn.functional.grid_sample(flow, pt, mode=mode, align_corners=align_corners)
     
     # make an array to track the trajectories 
     if calc_trace:
-        trace = torch.clone(pt).detach()
-        # trace = torch.zeros((niter,)+pt.shape) # slower to preallocate...
+        # preallocate, concatenating every step copies the whole history each time (quadratic)
+        # the starting point is stored twice (before the loop and at t=0), as it always has been 
+        trace = torch.empty((niter+1,)+pt.shape[1:], dtype=pt.dtype, device=device)
+        trace[0] = pt
         # print('trace shape',trace.shape)
 
     # init 
     if omni and OMNI_INSTALLED:
-        dPt0 = torch.nn.functional.grid_sample(flow, pt, mode=mode, align_corners=align_corners)
+        dPt0 = sample(pt)
+        # suppression factors for the whole trajectory, indexed on the device each step
+        sf = torch.tensor([step_factor(t) for t in range(niter)], dtype=torch.float, device=device)
         # r = torch.zeros_like(p)
 
     #here is where the stepping happens 
     for t in range(niter):
         if calc_trace:
-            trace = torch.cat((trace,pt))
-            # trace[t] = pt.detach()
+            trace[t+1] = pt
         # align_corners default is False, just added to suppress warning
-        dPt = torch.nn.functional.grid_sample(flow, pt, mode=mode, align_corners=align_corners)#see how nearest changes things 
+        dPt = sample(pt)#see how nearest changes things 
         ### here is where I could add something for a potential, random step, etc. 
 
         # for k in range(d): 
@@ -1044,12 +1431,13 @@ def steps_interp(p, dP, niter, use_gpu=True, device=None, omni=True, calc_trace=
 
 
         if omni and OMNI_INSTALLED:
-            dPt = (dPt+dPt0) / 2. # average with previous flow 
-            dPt0 = dPt.clone() # update old flow 
-            dPt /= step_factor(t) # suppression factor 
+            # in place: dPt is a fresh grid_sample output and dPt0 keeps its buffer, so no temporaries or clone 
+            dPt.add_(dPt0).mul_(0.5) # average with previous flow 
+            dPt0.copy_(dPt) # update old flow 
+            dPt.div_(sf[t]) # suppression factor 
 
-        for k in range(d): #clamp the final pixel locations
-            pt[...,k] = torch.clamp(pt[...,k] + dPt[:,k], -1., 1.)
+        # step and clamp the final pixel locations, dPt has the components on axis 1 
+        pt.add_(dPt.movedim(1,-1)).clamp_(-1.,1.)
         
         # # differene gets rid pf 
         # r = (torch.sum((pt-pt0)**2,axis=-1))**0.5
@@ -1061,14 +1449,10 @@ def steps_interp(p, dP, niter, use_gpu=True, device=None, omni=True, calc_trace=
         
         # snapping to coordinate locations is no good... distance of points to all original 
     #undo the normalization from before, reverse order of operations 
-    pt = (pt+1)*0.5
-    for k in range(d): 
-        pt[...,k] *= shape[k]
+    pt.add_(1).mul_(0.5).mul_(shape_t)
 
     if calc_trace:
-        trace = (trace+1)*0.5
-        for k in range(d): 
-            trace[...,k] *= shape[k]
+        trace.add_(1).mul_(0.5).mul_(shape_t)
         # print('trace shape',trace.shape)
 
     #pass back to cpu
@@ -1084,7 +1468,7 @@ def steps_interp(p, dP, niter, use_gpu=True, device=None, omni=True, calc_trace=
         omnipose_logger.info('steps_interp() execution time: {0:.3g} sec'.format(executionTime))
     return p, tr
 
-@njit('(float32[:,:,:,:],float32[:,:,:,:], int32[:,:], int32)', nogil=True)
+@njit('(float32[:,:,:,::1],float32[:,:,:,::1], int32[:,::1], int32)', nogil=True, parallel=True)
 def steps3D(p, dP, inds, niter):
     """ Run dynamics of pixels to recover masks in 3D.
     
@@ -1098,6 +1482,7 @@ def steps3D(p, dP, inds, niter):
         flows [axis x Lz x Ly x Lx]
     inds: int32, 2D array
         non-zero pixels to run dynamics on [npixels x 3]
+        (all arrays C-contiguous, so the compiled indexing can assume unit stride)
     niter: int32
         number of iterations of dynamics to run
 
@@ -1110,7 +1495,7 @@ def steps3D(p, dP, inds, niter):
     shape = p.shape[1:]
     for t in range(niter):
         #pi = p.astype(np.int32)
-        for j in range(inds.shape[0]):
+        for j in prange(inds.shape[0]): # each pixel only reads and writes its own coordinates
             z = inds[j,0]
             y = inds[j,1]
             x = inds[j,2]
@@ -1120,7 +1505,15 @@ def steps3D(p, dP, inds, niter):
             p[2,z,y,x] = min(shape[2]-1, max(0, p[2,z,y,x] + dP[2,p0,p1,p2]))
     return p, None
 
-@njit('(float32[:,:,:], float32[:,:,:], int32[:,:], int32, boolean, boolean)', nogil=True)
+@njit(nogil=True)
+def euler_step2D(p, dP, y, x, sf):
+    # step one pixel, the flow is divided into a new value rather than in place (dP[:,p0,p1] is a view)
+    shape = p.shape[1:]
+    p0, p1 = int(p[0,y,x]), int(p[1,y,x])
+    for k in range(p.shape[0]):
+        p[k,y,x] = min(shape[k]-1, max(0, p[k,y,x] + dP[k,p0,p1]/sf))
+
+@njit('(float32[:,:,::1], float32[:,:,::1], int32[:,::1], int32, boolean, boolean)', nogil=True, parallel=True)
 def steps2D(p, dP, inds, niter, omni=True, calc_trace=False):
     """ Run dynamics of pixels to recover masks in 2D.
     
@@ -1134,6 +1527,7 @@ def steps2D(p, dP, inds, niter, omni=True, calc_trace=False):
         flows [axis x Ly x Lx]
     inds: int32, 2D array
         non-zero pixels to run dynamics on [npixels x 2]
+        (all arrays C-contiguous, so the compiled indexing can assume unit stride)
     niter: int32
         number of iterations of dynamics to run
 
@@ -1149,23 +1543,36 @@ def steps2D(p, dP, inds, niter, omni=True, calc_trace=False):
         Lx = shape[1]
         tr = np.zeros((niter,2,Ly,Lx))
     for t in range(niter):
-        for j in range(inds.shape[0]):
-            if calc_trace:
-                tr[t] = p.copy()
-            # starting coordinates
-            y = inds[j,0]
-            x = inds[j,1]
-            p0, p1 = int(p[0,y,x]), int(p[1,y,x])
-            step = dP[:,p0,p1]
-            if omni and OMNI_INSTALLED:
-                step /= step_factor(t)
-            for k in range(p.shape[0]):
-                p[k,y,x] = min(shape[k]-1, max(0, p[k,y,x] + step[k]))
+        sf = np.float32(step_factor(t) if omni and OMNI_INSTALLED else 1)
+        if calc_trace: # snapshot once per step, before the pixels move 
+            tr[t] = p
+        for j in prange(inds.shape[0]): # pixels are independent within a step
+            euler_step2D(p, dP, inds[j,0], inds[j,1], sf)
     return p, tr
 
 # now generalized and simplified. Will work for ND if dependencies are updated. 
+def get_pixel_grid(shape):
+    """ float32 meshgrid of pixel coordinates for an array of the given shape.
+    
+    Not cached: a full-size grid per shape (>1 GB for a 512**3 volume) is too much to keep around, 
+    and np.indices builds it in float32 in one allocation anyway. 
+
+    Parameters
+    --------------
+    shape: tuple, int
+        spatial shape of the array
+
+    Returns
+    --------------
+    float32, ND array [axis x Lz x Ly x Lx]
+
+    """
+    # not sure why, but I had changed this to float64 at some point... tests showed that map_coordinates expects float32
+    # possible issues elsewhere? 
+    return np.indices(shape, dtype=np.float32)
+
 def follow_flows(dP, inds, niter=200, interp=True, use_gpu=True, 
-                 device=None, omni=True, calc_trace=False, verbose=False):
+                 device=None, omni=True, calc_trace=False, verbose=False, half=False):
     """ define pixels and run dynamics to recover masks in 2D
     
     Pixels are meshgrid. Only pixels with non-zero cell-probability
@@ -1175,8 +1582,8 @@ def follow_flows(dP, inds, niter=200, interp=True, use_gpu=True,
     ----------------
     dP: float32, 3D or 4D array
         flows [axis x Ly x Lx] or [axis x Lz x Ly x Lx]
-    inds: int, ND array 
-        initial indices of pixels for the Euler integration 
+    inds: int, ND array
+        initial indices of pixels for the Euler integration [ndim x npixels]
     niter: int 
         number of iterations of dynamics to run
     interp: bool 
@@ -1187,6 +1594,8 @@ def follow_flows(dP, inds, niter=200, interp=True, use_gpu=True,
         flag to enable Omnipose suppressed Euler integration etc. 
     calc_trace: bool 
         flag to store and retrun all pixel coordinates during Euler integration (slow)
+    half: bool 
+        sample the flow field in float16 during interpolated dynamics on CUDA 
 
     Returns
     ---------------
@@ -1201,16 +1610,12 @@ def follow_flows(dP, inds, niter=200, interp=True, use_gpu=True,
     d = dP.shape[0] # dimension is the number of flow components 
     shape = np.array(dP.shape[1:]).astype(np.int32) # shape of masks is the shape of the component field
     niter = np.uint32(niter) 
-    grid = [np.arange(shape[i]) for i in range(d)]
-    p = np.meshgrid(*grid, indexing='ij')
-    # not sure why, but I had changed this to float64 at some point... tests showed that map_coordinates expects float32
-    # possible issues elsewhere? 
-    p = np.array(p).astype(np.float32)
+    # a new grid every call, both branches below write into p 
+    p = get_pixel_grid(tuple(shape))
     # added inds for debugging while preserving backwards compatibility 
     
     if inds.ndim < 2 or inds.shape[0] < d:
-        print(inds.shape,d)
-        omnipose_logger.warning('WARNING: no mask pixels found')
+        omnipose_logger.warning('WARNING: no mask pixels found (inds shape %s, dim %d)', tuple(inds.shape), d)
         return p, inds, None
 
     cell_px = (Ellipsis,)+tuple(inds)
@@ -1218,17 +1623,22 @@ def follow_flows(dP, inds, niter=200, interp=True, use_gpu=True,
 
     if not interp:
         omnipose_logger.warning('WARNING: not interp')
+        # the jitted steppers loop over a [npixels x ndim] list of the active pixels only
+        # (and no longer modify dP, so no copy is needed)
+        # the steppers are compiled for C-contiguous arrays (p from get_pixel_grid already is)
+        pix = np.ascontiguousarray(inds.T, dtype=np.int32)
+        dP = np.ascontiguousarray(dP, dtype=np.float32)
         if d==2:
-            p, tr = steps2D(p, dP.astype(np.float32), inds, niter,omni=omni,calc_trace=calc_trace)
+            p, tr = steps2D(p, dP, pix, niter,omni=omni,calc_trace=calc_trace)
         elif d==3:
-            p, tr = steps3D(p, dP, inds, niter)
+            p, tr = steps3D(p, dP, pix, niter)
         else:
             omnipose_logger.warning('No non-interp code available for non-2D or -3D inputs.')
 
     else:
         p_interp, tr = steps_interp(p[cell_px], dP, niter, use_gpu=use_gpu,
                                     device=device, omni=omni, calc_trace=calc_trace, 
-                                    verbose=verbose)
+                                    verbose=verbose, half=half)
         p[cell_px] = p_interp
     return p, inds, tr
 
@@ -1300,11 +1710,13 @@ def flow_error(maski, dP_net, use_gpu=False, device=None, omni=True):
     # flows predicted from estimated masks
     idx = -1 # flows are the last thing returned now
     dP_masks = masks_to_flows(maski, use_gpu=use_gpu, device=device, omni=omni)[idx] ##### dynamics.masks_to_flows
-    # difference between predicted flows vs mask flows
-    flow_errors = np.zeros(maski.max())
-    for i in range(dP_masks.shape[0]):
-        flow_errors += mean((dP_masks[i] - dP_net[i]/5.)**2, maski, #the /5 is to compensate for the *5 we do for training
-                            index=np.arange(1, maski.max()+1))
+    # difference between predicted flows vs mask flows, summed over components first 
+    sq_err = np.sum((dP_masks - dP_net/5.)**2, axis=0) #the /5 is to compensate for the *5 we do for training
+    # per-label mean with two bincounts over the flattened labels 
+    lbl = maski.ravel().astype(np.intp,copy=False)
+    counts = np.bincount(lbl, minlength=maski.max()+1)
+    sums = np.bincount(lbl, weights=sq_err.ravel(), minlength=counts.size)
+    flow_errors = sums[1:] / np.maximum(counts[1:],1)
     return flow_errors, dP_masks
 
 
@@ -1315,7 +1727,8 @@ def flow_error(maski, dP_net, use_gpu=False, device=None, omni=True):
 # Spacetime segmentation: augmentations need to treat time differently 
 # Need to assume a particular axis is the temporal axis; most convenient is tyx. 
 def random_rotate_and_resize(X, Y=None, scale_range=1., gamma_range=0.5, tyx = (224,224), 
-                             do_flip=True, rescale=None, inds=None, nchan=1, nclasses=4):
+                             do_flip=True, rescale=None, inds=None, nchan=1, nclasses=4, 
+                             use_gpu=False, device=None):
     """ augmentation by random rotation and resizing
 
         X and Y are lists or arrays of length nimg, with channels x Lt x Ly x Lx (channels optional, Lt only in 3D)
@@ -1343,6 +1756,11 @@ def random_rotate_and_resize(X, Y=None, scale_range=1., gamma_range=0.5, tyx = (
             image indices (for debugging)
         nchan: int
             number of channels the images have 
+        use_gpu: bool
+            warp all the images in one batched grid_sample call on the GPU 
+            (labels are still warped per image, as crops are redrawn until they contain cells)
+        device: torch device
+            device for the batched image warp (defaults to the GPU)
 
         Returns
         -------
@@ -1363,12 +1781,15 @@ def random_rotate_and_resize(X, Y=None, scale_range=1., gamma_range=0.5, tyx = (
     if Y is not None:
         for n in range(nimg):
             masks = Y[n] # now assume straight labels 
-            iscell = masks>0
-            if np.sum(iscell)==0:
+            if not np.any(masks):
                 error_message = 'No cell pixels. Index is'+str(n)
                 omnipose_logger.critical(error_message)
                 raise ValueError(error_message)
-            Y[n] = np.stack([masks,iscell])
+            # images can differ in size, so fill one stack per image in place of stacking temporaries 
+            y = np.empty((2,)+masks.shape, masks.dtype)
+            y[0] = masks
+            np.greater(masks, 0, out=y[1])
+            Y[n] = y
     
     nt = 2 # instance seg (labels), semantic seg (cellprob)
     if nclasses==4:
@@ -1377,24 +1798,38 @@ def random_rotate_and_resize(X, Y=None, scale_range=1., gamma_range=0.5, tyx = (
     lbl = np.zeros((nimg, nt)+tyx, np.float32)
     scale = np.zeros((nimg,dim), np.float32)
     
+    if use_gpu and device is None:
+        device = torch_GPU
+    warps = [None]*nimg
+        
     for n in range(nimg):
-        img = X[n].copy()
+        img = X[n] # never written to, so no need to copy 
         y = None if Y is None else Y[n]
         # use recursive function here to pass back single image that was cropped appropriately 
         # # print(y.shape)
         # skimage.io.imsave('/home/kcutler/DataDrive/debug/img_orig.png',img[0])
         # skimage.io.imsave('/home/kcutler/DataDrive/debug/label_orig.tiff',y[n]) #so at this point the bad label is just fine 
-        imgi[n], lbl[n], scale[n] = random_crop_warp(img, y, nt, tyx, nchan, scale[n], 
-                                                     rescale is None if rescale is None else rescale[n], 
-                                                     scale_range, gamma_range, do_flip, 
-                                                     inds is None if inds is None else inds[n], dist_bg)
+        out, lbl[n], scale[n] = random_crop_warp(img, y, nt, tyx, nchan, scale[n], 
+                                                 rescale is None if rescale is None else rescale[n], 
+                                                 scale_range, gamma_range, do_flip, 
+                                                 inds is None if inds is None else inds[n], dist_bg, 
+                                                 warp_image=not use_gpu)
+        if use_gpu:
+            warps[n] = out # (M, offset, flips) of the accepted crop 
+        else:
+            imgi[n] = out
+    
+    # one kernel for every channel of every image, then the intensity augmentations on the device too
+    if use_gpu:
+        imgi = do_warp_batch_torch(X, warps, tyx, nchan, device)
+        imgi = augment_intensity_torch(imgi, gamma_range/2).cpu().numpy()
         
     return imgi, lbl, np.mean(scale) #for size training, must output scalar size (need to check this again)
 
 # This function allows a more efficient implementation for recursively checking that the random crop includes cell pixels.
 # Now it is rerun on a per-image basis if a crop fails to capture .1 percent cell pixels (minimum). 
 def random_crop_warp(img, Y, nt, tyx, nchan, scale, rescale, scale_range, gamma_range, 
-                     do_flip, ind, dist_bg, depth=0):
+                     do_flip, ind, dist_bg, depth=0, warp_image=True):
     """
     This sub-fuction of `random_rotate_and_resize()` recursively performs random cropping until 
     a minimum number of cell pixels are found, then proceeds with augemntations. 
@@ -1426,6 +1861,8 @@ def random_crop_warp(img, Y, nt, tyx, nchan, scale, rescale, scale_range, gamma_
         nonegative value X for assigning -X to where distance=0 (deprecated, now adapts to field values)
     depth: int
         how many time this function has been called on an image 
+    warp_image: bool
+        if False, the image is left for a batched warp and (M, offset, flips) is returned in place of imgi
 
     Returns
     -------
@@ -1458,7 +1895,7 @@ def random_crop_warp(img, Y, nt, tyx, nchan, scale, rescale, scale_range, gamma_
     
     numpx = np.prod(tyx)
     if Y is not None:
-        labels = Y.copy()
+        labels = Y # do_warp only reads the labels 
         # We want the scale distibution to have a mean of 1
         # There may be a better way to skew the distribution to
         # interpolate the parameter space without skewing the mean 
@@ -1478,7 +1915,13 @@ def random_crop_warp(img, Y, nt, tyx, nchan, scale, rescale, scale_range, gamma_
     v1 = [0]*(dim-1)+[1]
     v2 = [0]*(dim-2)+[1,0]
     # M = mgen.rotation_from_angle_and_plane(theta,v1,v2) #not generalizing correctly to 3D? had -theta before  
-    M = mgen.rotation_from_angle_and_plane(-theta,v2,v1).dot(np.diag(scale)) #equivalent
+    if dim==2:
+        # same matrix as below (rotation by -theta in the yx plane, then scaling), without the mgen overhead 
+        c, sn = math.cos(theta), math.sin(theta)
+        M = np.array([[ c*scale[0], sn*scale[1]],
+                      [-sn*scale[0], c*scale[1]]])
+    else:
+        M = mgen.rotation_from_angle_and_plane(-theta,v2,v1).dot(np.diag(scale)) #equivalent
     # could define v3 and do another rotation here and compose them 
 
     axes = range(dim)
@@ -1494,7 +1937,7 @@ def random_crop_warp(img, Y, nt, tyx, nchan, scale, rescale, scale_range, gamma_
     mode = 'reflect'
     if Y is not None:
         for k in [0,1]:#[i for i in range(nt) if i not in range(2,5)]: used to do first two and flows, now just first two
-            l = labels[k].copy()
+            l = labels[k]
             if k==0:
                 lbl[k] = do_warp(l, M, tyx, offset=offset, order=0, mode=mode) # order 0 is 'nearest neighbor'
                 # check to make sure the region contains at enough cell pixels; if not, retry
@@ -1507,7 +1950,8 @@ def random_crop_warp(img, Y, nt, tyx, nchan, scale, rescale, scale_range, gamma_
                     # skimage.io.imsave('/home/kcutler/DataDrive/debug/img'+str(depth)+'.png',img[0])
                     # skimage.io.imsave('/home/kcutler/DataDrive/debug/training'+str(depth)+'.png',lbl[0])
                     return random_crop_warp(img, Y, nt, tyx, nchan, scale, rescale, scale_range, 
-                                            gamma_range, do_flip, ind, dist_bg, depth=depth+1)
+                                            gamma_range, do_flip, ind, dist_bg, depth=depth+1, 
+                                            warp_image=warp_image)
             else:
                 lbl[k] = do_warp(l, M, tyx, offset=offset, mode=mode)
                 # if k==1:
@@ -1538,75 +1982,239 @@ def random_crop_warp(img, Y, nt, tyx, nchan, scale, rescale, scale_range, gamma_
 
     # Makes more sense to spend time on image augmentations
     # after the label augmentation succeeds without triggering recursion 
-    imgi  = np.zeros((nchan,)+tyx, np.float32)
-    for k in range(nchan): # replace k with slice that handles when nchan=0
-        I = do_warp(img[k], M, tyx, offset=offset, mode=mode)
-        
-        # gamma agumentation 
-        gamma = np.random.uniform(low=1-dg,high=1+dg) 
-        imgi[k] = I ** gamma
-        
-        # percentile clipping augmentation 
-        dp = 10
-        dpct = np.random.triangular(left=0, mode=0, right=dp, size=2) # weighted toward 0
-        imgi[k] = utils.normalize99(imgi[k],upper=100-dpct[0],lower=dpct[1])
-        
-        # noise augmentation 
-        if SKIMAGE_ENABLED:
-            
-            # imgi[k] = random_noise(utils.rescale(imgi[k]), mode="poisson")#, seed=None, clip=True)
-            imgi[k] = random_noise(utils.rescale(imgi[k]), mode="poisson")#, seed=None, clip=True)
-            
-        else:
-            #this is quite different
-            # imgi[k] = np.random.poisson(imgi[k])
-            print('warning,no randomnoise')
-            
-        # bit depth augmentation
-        bit_shift = int(np.random.triangular(left=0, mode=8, right=16, size=1))
-        im = (imgi[k]*(2**16-1)).astype(np.uint16)
-        imgi[k] = utils.normalize99(im>>bit_shift)
-    
+    if warp_image:
+        imgi  = np.zeros((nchan,)+tyx, np.float32)
+        I = do_warp(img[:nchan], M, tyx, offset=offset, mode=mode) # every channel in one warp 
+        for k in range(nchan): # replace k with slice that handles when nchan=0
+            augment_intensity(I[k], dg, imgi[k])
+    else:
+        imgi = None
     
     # Moved to the end because it conflicted with the recursion. 
     # Also, flipping the crop is ultimately equivalent and slightly faster.         
     # We now flip along every axis (randomly); could make do_flip a list to avoid some axes if needed
+    flips = []
     if do_flip:
-        for d in range(1,dim+1):
-            flip = np.random.choice([0,1])
-            if flip:
-                imgi = np.flip(imgi,axis=-d) 
-                if Y is not None:
-                    lbl = np.flip(lbl,axis=-d)
-                    if nt > 1:
-                        lbl[-d] = -lbl[-d]        
+        flips = [d for d in range(1,dim+1) if np.random.choice([0,1])]
+    if len(flips):
+        # flip all the chosen axes at once and negate the matching flow components together
+        axes = tuple([-d for d in flips])
+        if imgi is not None:
+            imgi = np.flip(imgi,axis=axes) 
+        if Y is not None:
+            lbl = np.flip(lbl,axis=axes)
+            if nt > 1:
+                lbl[list(axes)] *= -1
+    
+    if not warp_image:
+        imgi = (M, offset, flips)
         
     return imgi, lbl, scale
 
+def augment_intensity(I, dg, out):
+    """ Random gamma, percentile clipping, noise, and bit depth augmentations of a warped image channel. 
+    
+    Parameters
+    --------------
+    I: NDarray, float
+        warped image channel
+    dg: float
+        half the gamma range; gamma is drawn from (1-dg,1+dg)
+    out: NDarray, float32
+        array the augmented channel (normalized to 0-1) is written into, may be I itself
+        
+    """
+    # gamma agumentation 
+    gamma = np.random.uniform(low=1-dg,high=1+dg) 
+    out[:] = I ** gamma
+
+    # percentile clipping augmentation 
+    dp = 10
+    dpct = np.random.triangular(left=0, mode=0, right=dp, size=2) # weighted toward 0
+    out[:] = utils.normalize99(out,upper=100-dpct[0],lower=dpct[1])
+
+    # noise augmentation 
+    if SKIMAGE_ENABLED:
+
+        # imgi[k] = random_noise(utils.rescale(imgi[k]), mode="poisson")#, seed=None, clip=True)
+        out[:] = random_noise(utils.rescale(out), mode="poisson")#, seed=None, clip=True)
+
+    else:
+        #this is quite different
+        # imgi[k] = np.random.poisson(imgi[k])
+        if omnipose_logger.isEnabledFor(logging.DEBUG):
+            omnipose_logger.debug('warning, no randomnoise')
+
+    # bit depth augmentation
+    bit_shift = int(np.random.triangular(left=0, mode=8, right=16, size=1))
+    im = (out*(2**16-1)).astype(np.uint16)
+    out[:] = utils.normalize99(im>>bit_shift)
+
+def _normalize99_rows(X, lower, upper):
+    """ utils.normalize99 along each row of X, with per-row percentiles (numpy 'linear' method)."""
+    n = X.shape[1]
+    Xs = X.sort(dim=1).values
+    bounds = []
+    for q in (lower, upper):
+        pos = q/100*(n-1)
+        lo = pos.floor().long()
+        hi = (lo+1).clamp_max(n-1)
+        frac = (pos-lo)[:,None].to(X.dtype) # positions in float64 for exact indices, but keep X in its dtype
+        vlo, vhi = Xs.gather(1,lo[:,None]), Xs.gather(1,hi[:,None])
+        bounds.append(vlo + frac*(vhi-vlo))
+    lo, hi = bounds
+    # np.interp with equal end points is a step at that value 
+    return torch.where(hi>lo, ((X-lo)/(hi-lo).clamp_min(1e-30)).clamp(0,1), (X>=lo).float())
+
+def augment_intensity_torch(X, dg):
+    """ Batched version of augment_intensity() for every channel of every image at once. 
+    
+    The random parameters are drawn by numpy per channel in the same order as augment_intensity(), 
+    only the Poisson noise is sampled by torch (on the device of X).
+    
+    Parameters
+    --------------
+    X: torch tensor, float32
+        warped images [nimg x nchan x ...]
+    dg: float
+        half the gamma range; gamma is drawn from (1-dg,1+dg)
+        
+    Returns
+    --------------
+    torch tensor of the augmented channels, normalized to 0-1, same shape as X
+    
+    """
+    shape = X.shape
+    X = X.reshape(shape[0]*shape[1],-1) # one row per channel 
+    B = X.shape[0]
+    gamma = np.empty(B)
+    dpct = np.empty((B,2))
+    bit_shift = np.empty(B,np.int32)
+    for b in range(B):
+        gamma[b] = np.random.uniform(low=1-dg,high=1+dg) 
+        dpct[b] = np.random.triangular(left=0, mode=0, right=10, size=2) # weighted toward 0
+        bit_shift[b] = int(np.random.triangular(left=0, mode=8, right=16, size=1))
+    as_t = lambda a: torch.as_tensor(a, device=X.device)
+    
+    # gamma agumentation 
+    X = X ** as_t(gamma).float()[:,None]
+    
+    # percentile clipping augmentation 
+    X = _normalize99_rows(X, as_t(dpct[:,1]), 100-as_t(dpct[:,0]))
+    
+    # noise augmentation, as skimage random_noise(rescale(X), mode='poisson'): 
+    # the noise level is set by the next power of two above the number of unique values
+    mn, mx = X.amin(1,keepdim=True), X.amax(1,keepdim=True)
+    X = torch.where(mx>mn, (X-mn)/(mx-mn).clamp_min(1e-30), (X>=mn).float()) # same step as np.interp
+    nvals = 1 + (X.sort(dim=1).values.diff(dim=1)!=0).sum(1,keepdim=True)
+    vals = 2**torch.ceil(torch.log2(nvals.float()))
+    X = (torch.poisson(X*vals)/vals).clamp(0,1)
+    
+    # bit depth augmentation
+    im = (X*(2**16-1)).int() >> as_t(bit_shift)[:,None]
+    X = _normalize99_rows(im.float(), as_t(np.full(B,0.01)), as_t(np.full(B,99.99)))
+    return X.reshape(shape)
+
 def do_warp(A,M,tyx,offset=0,order=1,mode='constant'):#,mode,method):
     """ Wrapper function for affine transformations during augmentation. 
-    Uses scipy.ndimage.affine_transform().
+    Uses cv2.warpAffine() for 2D reflect-padded warps (SIMD, several times faster) 
+    and scipy.ndimage.affine_transform() otherwise.
         
     Parameters
     --------------
     A: NDarray, int or float
-        input image to be transformed
+        input image to be transformed, or a stack of them along the first axis 
+        (all warped the same way, in a single call for 2D)
     M: NDarray, float
         tranformation matrix
     order: int
         interpolation order, 1 is equivalent to 'nearest',
     """
-    # dim = A.ndim'
-    # if dim == 2:
-    #     return cv2.warpAffine(A, M, rshape, borderMode=mode, flags=method)
-    # else:
-    #     return np.stack([cv2.warpAffine(A[k], M, rshape, borderMode=mode, flags=method) for k in range(A.shape[0])])
-    # print('debug',A.shape,M.shape,tyx)
-    
-    return scipy.ndimage.affine_transform(A, np.linalg.inv(M), offset=offset, 
+    Minv = np.linalg.inv(M)
+    stack = A.ndim > len(tyx)
+    # scipy 'constant' also interpolates against the padding at the edges, which cv2 does not reproduce 
+    if len(tyx) == 2 and mode == 'reflect':
+        # Both map output coordinates to input coordinates, but cv2 is in (x,y) order. 
+        # cv2 has no int32/int64 support and label values are exact in float32 up to 2^24.  
+        offset = np.broadcast_to(offset,(2,))
+        M_cv = np.array([[Minv[1,1], Minv[1,0], offset[1]],
+                         [Minv[0,1], Minv[0,0], offset[0]]])
+        flags = (cv2.INTER_NEAREST if order==0 else cv2.INTER_LINEAR) | cv2.WARP_INVERSE_MAP
+        # cv2 warps all channels of a channels-last image at once 
+        src = np.moveaxis(A,0,-1) if stack else A
+        W = cv2.warpAffine(np.ascontiguousarray(src, dtype=np.float32), M_cv, (tyx[1],tyx[0]), 
+                           flags=flags, borderMode=cv2.BORDER_REFLECT)
+        if stack:
+            W = np.moveaxis(W.reshape(tuple(tyx)+(-1,)),-1,0) # single channels come back without the axis 
+        if np.issubdtype(A.dtype, np.integer):
+            W = np.rint(W) # scipy rounds to integer outputs 
+        return W.astype(A.dtype,copy=False)
+    
+    if stack:
+        return np.stack([scipy.ndimage.affine_transform(a, Minv, offset=offset, output_shape=tyx, 
+                                                        order=order, mode=mode) for a in A])
+    return scipy.ndimage.affine_transform(A, Minv, offset=offset, 
                                           output_shape=tyx, order=order, mode=mode)
     
 
+def do_warp_batch_torch(X, warps, tyx, nchan, device):
+    """ Apply per-image affine warps (as in do_warp, mode='reflect') to a list of images 
+    in a single grid_sample call. 
+    
+    Images may differ in size, so they are zero-padded to a common shape. The sampling 
+    coordinates are reflected into each image's own extent beforehand, so the padding is never read. 
+    
+    Parameters
+    --------------
+    X: list of NDarrays
+        images of size [nchan x Ly x Lx] or [nchan x Lz x Ly x Lx]
+    warps: list of tuples
+        (M, offset, flips) for each image, as returned by random_crop_warp(warp_image=False)
+    tyx: tuple, int
+        output shape
+    nchan: int
+        number of channels to warp
+    device: torch device
+        what compute hardware to use
+    
+    Returns
+    --------------
+    torch tensor [nimg x nchan x tyx], float32
+    
+    """
+    dim = len(tyx)
+    sizes = [x.shape[-dim:] for x in X]
+    shape = np.max(sizes,axis=0)
+    batch = torch.zeros((len(X),nchan)+tuple(shape), dtype=torch.float32, device=device)
+    for n,x in enumerate(X):
+        batch[(n,)+(slice(None),)+tuple([slice(0,l) for l in sizes[n]])] = torch.as_tensor(np.asarray(x[:nchan],np.float32), 
+                                                                                               device=device)
+    # output pixel coordinates, dim x tyx 
+    coords = torch.stack(torch.meshgrid(*[torch.arange(l, dtype=torch.float32, device=device) for l in tyx], 
+                                        indexing='ij'))
+    expand = (slice(None),)+(None,)*dim
+    grids = []
+    for n,(M,offset,flips) in enumerate(warps):
+        Minv = torch.as_tensor(np.linalg.inv(M), dtype=torch.float32, device=device)
+        offset = torch.tensor(np.array(np.broadcast_to(offset,(dim,))), dtype=torch.float32, device=device)
+        c = torch.tensordot(Minv, coords, dims=1) + offset[expand]
+        if len(flips):
+            c = c.flip([-d for d in flips]) # flipping the output is flipping where it samples from 
+        
+        # scipy 'reflect' mirrors about the pixel edges (-0.5 and L-0.5); clamping to the pixel centers 
+        # afterwards only drops interpolation weight that the mirror would have put back on the same pixel 
+        L = torch.tensor(sizes[n], dtype=torch.float32, device=device)[expand]
+        c = torch.remainder(c+0.5, 2*L)
+        c = torch.where(c>=L, 2*L-c, c) - 0.5
+        c = torch.minimum(c.clamp_min(0), L-1)
+        
+        # align_corners=True puts -1 and 1 on the first and last pixel centers; grid_sample wants (x,y,z) order 
+        S = torch.tensor(shape-1, dtype=torch.float32, device=device).clamp_min(1)[expand]
+        grids.append((2*c/S-1).flip(0).movedim(0,-1))
+    
+    return torch.nn.functional.grid_sample(batch, torch.stack(grids), mode='bilinear', 
+                                           padding_mode='border', align_corners=True)
+
 
 def loss(self, lbl, y):
     """ Loss function for Omnipose.
@@ -1718,38 +2326,19 @@ def smooth_distance(masks, dists=None, device=None):
     pad = 1
     
     masks_padded = np.pad(masks,pad)
-    coords = np.nonzero(masks_padded)
-    d = len(coords)
-    idx = (3**d)//2 # center pixel index
-
-    neigh = [[-1,0,1] for i in range(d)]
-    steps = cartesian(neigh)
-    neighbors = np.array([np.add.outer(coords[i],steps[:,i]) for i in range(d)]).swapaxes(-1,-2)
-    # print('neighbors d', neighbors.shape)
-    
-    # get indices of the hupercubes sharing m-faces on the central n-cube
-    sign = np.sum(np.abs(steps),axis=1) # signature distinguishing each kind of m-face via the number of steps 
-    uniq = fastremap.unique(sign)
-    inds = [np.where(sign==i)[0] for i in uniq] # 2D: [4], [1,3,5,7], [0,2,6,8]. 1-7 are y axis, 3-5 are x, etc. 
-    fact = np.sqrt(uniq) # weighting factor for each hypercube group 
-    
-    # get neighbor validator (not all neighbors are in same mask)
-    neighbor_masks = masks_padded[tuple(neighbors)] #extract list of label values, 
-    isneighbor = neighbor_masks == neighbor_masks[idx] 
+    d = masks.ndim
 
     # set number of iterations
     n_iter = get_niter(dists)
     # n_iter = 20
     # print('n_iter',n_iter)
+    
+    # This is exactly the Omnipose branch of the flow diffusion, so share it: the whole padded array is 
+    # updated from shifted views each step (no per-pixel gather and scatter), replayed from a CUDA graph 
+    # and with the fused update on GPU. 
+    T = _extend_centers_torch(masks_padded, np.array([]), n_iter=n_iter, device=device, omni=True)[1]
         
-    nimg = neighbors.shape[1] // (3**d)
-    pt = torch.from_numpy(neighbors).to(device)
-    T = torch.zeros((nimg,)+masks_padded.shape, dtype=torch.float, device=device)#(nimg,)+
-    isneigh = torch.from_numpy(isneighbor).to(device)
-    for t in range(n_iter):
-        T[(Ellipsis,)+tuple(pt[:,idx])] = eikonal_update_torch(T,pt,isneigh,d,inds,fact) 
-        
-    return T.cpu().squeeze().numpy()[tuple([slice(pad,-pad)]*d)]
+    return T.numpy()[tuple([slice(pad,-pad)]*d)]
 
 
 ### Section IV: duplicated mask recontruction
@@ -1761,6 +2350,106 @@ def smooth_distance(masks, dists=None, device=None):
 
 ### Section V: Helper functions duplicated from Cellpose, plan to find a way to merge them back without import loop
 
+@njit(parallel=True, cache=True)
+def _grow_seeds(hflat, hshape, seeds, steps, niter, nthreads):
+    """ Grow every seed niter times into its neighborhood (steps), keeping only pixels with h>2.
+    
+    After niter steps a seed can only have reached the (2*niter+1)**d window centered on it, 
+    so each seed is grown independently (in parallel) on its own window. The histogram is passed 
+    flattened so that one compiled (and cached) version serves 2D and 3D. 
+    
+    Parameters
+    --------------
+    hflat: float64, 1D array
+        flattened (C order) histogram of final pixel locations
+    hshape: int64, 1D array
+        shape of the histogram
+    seeds: int32, 2D array
+        [nseeds x ndim] seed coordinates 
+    steps: int32, 2D array
+        [3**ndim x ndim] steps to the neighborhood, including the zero step 
+    niter: int
+        number of times to grow the seeds
+    nthreads: int
+        number of per-thread scratch buffers (numba.get_num_threads() of the caller; 
+        calling it in here would keep numba from caching the kernel) 
+    
+    Returns
+    --------------
+    pix: int64, 1D array
+        flat indices into the histogram of the grown seeds, one seed after the other 
+    offsets: int64, 1D array
+        pix[offsets[k]:offsets[k+1]] belong to seed k
+    
+    """
+    K, d = seeds.shape
+    W = 2*niter+1
+    nw = W**d
+    
+    # local window coordinates and the window index of each of their neighbors (-1 if outside)
+    loc = np.empty((nw,d), np.int64)
+    for w in range(nw):
+        r = w
+        for i in range(d-1,-1,-1):
+            loc[w,i] = r % W
+            r //= W
+    nbr = np.empty((nw,steps.shape[0]), np.int64)
+    for w in range(nw):
+        for j in range(steps.shape[0]):
+            v = 0
+            for i in range(d):
+                l = loc[w,i] + steps[j,i]
+                if l < 0 or l >= W:
+                    v = -1
+                    break
+                v = v*W + l 
+            nbr[w,j] = v
+    
+    # grown doubles as the current front; the other scratch buffers are per thread rather than 
+    # allocated per seed (rebinding arrays inside prange is not safe, so everything is indexed) 
+    grown = np.zeros((K,nw), np.uint8)
+    nt = max(1, min(nthreads, K))
+    ok = np.empty((nt,nw), np.uint8)
+    new = np.empty((nt,nw), np.uint8)
+    for t in prange(nt):
+        for k in range(t, K, nt):
+            # which window pixels are inside the volume and have h>2 
+            for w in range(nw):
+                f = 0
+                inside = True
+                for i in range(d):
+                    g = seeds[k,i] - niter + loc[w,i]
+                    if np.uint64(g) >= np.uint64(hshape[i]): # negative g wraps around, one compare 
+                        inside = False
+                        break
+                    f = f*hshape[i] + g
+                ok[t,w] = inside and hflat[f] > 2
+            grown[k,nw//2] = 1
+            for it in range(niter):
+                new[t,:] = 0
+                for w in range(nw):
+                    if grown[k,w]:
+                        for j in range(nbr.shape[1]):
+                            v = nbr[w,j]
+                            if v >= 0 and ok[t,v]:
+                                new[t,v] = 1
+                grown[k,:] = new[t,:]
+    
+    offsets = np.zeros(K+1, np.int64)
+    for k in range(K):
+        offsets[k+1] = offsets[k] + np.sum(grown[k])
+    pix = np.empty(offsets[K], np.int64)
+    for k in prange(K):
+        n = offsets[k]
+        for w in range(nw):
+            if grown[k,w]:
+                f = 0
+                for i in range(d):
+                    f = f*hshape[i] + seeds[k,i] - niter + loc[w,i]
+                pix[n] = f
+                n += 1
+    return pix, offsets
+
 def get_masks_cp(p, iscell=None, rpad=20, flows=None, use_gpu=False, device=None):
     """ create masks using pixel convergence after running dynamics
     
@@ -1796,76 +2485,64 @@ def get_masks_cp(p, iscell=None, rpad=20, flows=None, use_gpu=False, device=None
     edges = []
     shape0 = p.shape[1:]
     dims = len(p)
-    if iscell is not None:
-        if dims==3:
-            inds = np.meshgrid(np.arange(shape0[0]), np.arange(shape0[1]),
-                np.arange(shape0[2]), indexing='ij')
-        elif dims==2:
-            inds = np.meshgrid(np.arange(shape0[0]), np.arange(shape0[1]),
-                     indexing='ij')
+    if iscell is not None and not np.all(iscell):
+        # pixels outside of cells go back to where they started; the sparse grid broadcasts, 
+        # so no dense meshgrid or gathered copies of it are needed 
+        outside = ~iscell
+        inds = np.indices(shape0, sparse=True)
         for i in range(dims):
-            p[i, ~iscell] = inds[i][~iscell]
+            np.copyto(p[i], inds[i], where=outside)
     
+    # smallest integer types that fit the padded histogram and the number of seeds (less memory traffic) 
+    coord_dtype = np.int16 if max(shape0)+2*rpad+1 < np.iinfo(np.int16).max else np.int32
     for i in range(dims):
-        pflows.append(p[i].flatten().astype('int32'))
+        pflows.append(p[i].astype(coord_dtype).ravel()) # one copy for the cast, ravel is a view
         edges.append(np.arange(-.5-rpad, shape0[i]+.5+rpad, 1))
 
-    h,_ = np.lib.histogramdd(pflows, bins=edges)
-    hmax = h.copy()
-    for i in range(dims):
-        hmax = maximum_filter1d(hmax, 5, axis=i)
-
+    # The bins are unit width and centered on the integers, so (instead of histogramdd searching the edges 
+    # along every axis) each point goes straight to bin pflows+rpad: one flat index and one bincount. 
+    # The dynamics keep p inside the image, so every point lands inside the padded histogram. 
+    shape = tuple([len(e)-1 for e in edges])
+    flat = np.ravel_multi_index(tuple([pf+rpad for pf in pflows]), shape)
+    h = np.bincount(flat, minlength=np.prod(shape)).reshape(shape).astype(np.float64)
+    # one call for the 5**dims window max, one output array (counts are >=0, so zero padding is the same as reflect)
+    hmax = maximum_filter(h, size=5, mode='constant', cval=0)
+
+    # seeds stay in raster order: the old sort by peak height never took effect (its loop only rebound s), 
+    # and the order decides which seed wins where the grown seeds overlap below 
     seeds = np.nonzero(np.logical_and(h-hmax>-1e-6, h>10))
-    Nmax = h[seeds]
-    isort = np.argsort(Nmax)[::-1]
-    for s in seeds:
-        s = s[isort]
-    pix = list(np.array(seeds).T)
 
+    # grow each seed 5 times into its neighborhood, keeping pixels with more than 2 final pixels p 
+    # (compiled and parallel over seeds; the list-based version accumulated duplicates every iteration)
     shape = h.shape
-    if dims==3:
-        expand = np.nonzero(np.ones((3,3,3)))
-    else:
-        expand = np.nonzero(np.ones((3,3)))
-    for e in expand:
-        e = np.expand_dims(e,1)
-
-    for iter in range(5):
-        for k in range(len(pix)):
-            if iter==0:
-                pix[k] = list(pix[k])
-            newpix = []
-            iin = []
-            for i,e in enumerate(expand):
-                epix = e[:,np.newaxis] + np.expand_dims(pix[k][i], 0) - 1
-                epix = epix.flatten()
-                iin.append(np.logical_and(epix>=0, epix<shape[i]))
-                newpix.append(epix)
-            iin = np.all(tuple(iin), axis=0)
-            for p in newpix:
-                p = p[iin]
-            newpix = tuple(newpix)
-            igood = h[newpix]>2
-            for i in range(dims):
-                pix[k][i] = newpix[i][igood]
-            if iter==4:
-                pix[k] = tuple(pix[k])
-    
-    M = np.zeros(h.shape, np.int32)
-    for k in range(len(pix)):
-        M[pix[k]] = 1+k
-        
-    for i in range(dims):
-        pflows[i] = pflows[i] + rpad
-    M0 = M[tuple(pflows)]
+    pix, offsets = _grow_seeds(h.ravel(), np.array(shape,dtype=np.int64), 
+                               np.ascontiguousarray(np.array(seeds).T, dtype=np.int32), 
+                               get_neighborhood(dims)[0].astype(np.int32), 5, get_num_threads())
+    
+    # label all the grown pixels in one write; where seeds overlap, the later (higher) label wins, 
+    # just like when the seeds were written one after the other 
+    label_dtype = np.uint16 if len(offsets) <= np.iinfo(np.uint16).max else np.int32
+    M = np.zeros(h.shape, label_dtype)
+    labels = np.repeat(np.arange(1,len(offsets),dtype=label_dtype), np.diff(offsets))
+    np.maximum.at(M.ravel(), pix, labels)
+    
+    # each pixel takes the label of the histogram bin its final location fell into
+    M0 = M.ravel()[flat]
     
     # remove big masks
-    _,counts = np.unique(M0, return_counts=True)
-    big = np.prod(shape0) * 0.4
-    for i in np.nonzero(counts > big)[0]:
-        M0[M0==i] = 0
-    _,M0 = np.unique(M0, return_inverse=True)
-    M0 = np.reshape(M0, shape0)
+    # one pass with a lookup table indexed by label (the loop used to remove by position in np.unique, 
+    # which is only the label when no label is missing) 
+    counts = np.bincount(M0)
+    remove = counts > np.prod(shape0) * 0.4
+    remove[0] = False
+    
+    # compact the remaining labels with a cumsum lookup table instead of the sort in np.unique 
+    # (same output: the smallest value left, 0 if there is any background, becomes 0) 
+    used = (counts > 0) & ~remove
+    used[0] |= remove.any()
+    lut = np.cumsum(used) - 1
+    lut[remove] = lut[0]
+    M0 = np.reshape(lut[M0], shape0)
 
     # moved to compute masks
     # if M0.max()>0 and threshold is not None and threshold > 0 and flows is not None:
@@ -1877,6 +2554,238 @@ def get_masks_cp(p, iscell=None, rpad=20, flows=None, use_gpu=False, device=None
 
 
 # duplicated from cellpose temporarily, neec to pass through spacetime before re-inseting 
+@njit(nogil=True, cache=True)
+def _object_holes(masks, lab, bb, thresh, inclusive, fill_all, dims, holes, write):
+    """ Find the holes of one object within its bounding box. 
+    
+    Everything in the box that is not the object is flood-filled into face-connected components. 
+    Components touching the box edge are one component together with the 1px padding that 
+    remove_small_holes would see around the box. A component is a hole when it is smaller than 
+    thresh (or equal, if inclusive), or (fill_all, binary_fill_holes) when it does not touch the edge. 
+    
+    Parameters
+    --------------
+    masks: int, 3D array
+        label matrix ([1 x Ly x Lx] in 2D)
+    lab: int
+        label of the object
+    bb: int64, 1D array
+        bounding box [z0,y0,x0,z1,y1,x1] (end exclusive)
+    thresh: float
+        hole area threshold 
+    inclusive: bool
+        holes of exactly thresh pixels are filled too
+    fill_all: bool
+        fill every enclosed component regardless of size
+    dims: int
+        dimension of the label matrix (2 or 3)
+    holes: int64, 1D array
+        output flat indices of the hole pixels (only used if write)
+    write: bool
+        store the hole pixels in holes 
+    
+    Returns
+    --------------
+    nh: int
+        number of hole pixels
+    conflict: bool
+        the holes take in pixels of other labels or touch the box edge, 
+        i.e. filling them can change what the other objects see
+    
+    """
+    Lz, Ly, Lx = masks.shape
+    z0, y0, x0, z1, y1, x1 = bb[0], bb[1], bb[2], bb[3], bb[4], bb[5]
+    nz, ny, nx = z1-z0, y1-y0, x1-x0
+    n = nz*ny*nx
+    
+    # nothing to fill without flood filling: every hole has at least one pixel (and the outside 
+    # at least the frame), and for binary_fill_holes a box under 3px thick has no inside 
+    if fill_all:
+        if ny<3 or nx<3 or (dims==3 and nz<3):
+            return 0, False
+    elif thresh < 1 or (thresh <= 1 and not inclusive):
+        return 0, False
+    
+    # flat copy of the box with a 1px frame: 1 = not the object and not visited yet, 
+    # 0 = object or visited, 2 = frame (outside of the box). In 2D the frame above and below 
+    # the plane is a wall instead. The frame takes care of all the bounds checks. 
+    PY, PX = ny+2, nx+2
+    PYX = PY*PX
+    bg = np.zeros((nz+2)*PYX, np.uint8)
+    if dims==3:
+        bg[:PYX] = 2
+        bg[-PYX:] = 2
+    for z in range(nz):
+        for y in range(PY):
+            base = ((z+1)*PY+y)*PX
+            if y==0 or y==PY-1:
+                bg[base:base+PX] = 2
+                continue
+            bg[base] = 2
+            bg[base+PX-1] = 2
+            for x in range(nx):
+                if masks[z0+z,y0+y-1,x0+x]!=lab:
+                    bg[base+1+x] = 1
+    steps = np.array((-PYX,PYX,-PX,PX,-1,1), np.int64)
+    
+    # components are stored one after the other
+    queue = np.empty(n, np.int64) 
+    starts = np.empty(n+1, np.int64)
+    edge = np.zeros(n, np.bool_)
+    ncomp = 0
+    qend = 0
+    for s in range(bg.size):
+        if bg[s]!=1:
+            continue
+        starts[ncomp] = qend
+        bg[s] = 0
+        queue[qend] = s
+        qend += 1
+        head = starts[ncomp]
+        touches = False
+        while head<qend:
+            q = queue[head]
+            head += 1
+            for k in range(6):
+                t = q+steps[k]
+                v = bg[t]
+                if v==1:
+                    bg[t] = 0
+                    queue[qend] = t
+                    qend += 1
+                elif v==2:
+                    touches = True
+        edge[ncomp] = touches
+        ncomp += 1
+    starts[ncomp] = qend
+    
+    # size of the outside: the padding plus all the components touching the edge 
+    if dims==3:
+        outer = (nz+2)*(ny+2)*(nx+2)-n
+    else:
+        outer = (ny+2)*(nx+2)-n
+    for c in range(ncomp):
+        if edge[c]:
+            outer += starts[c+1]-starts[c]
+    
+    nh = 0
+    conflict = False
+    for c in range(ncomp):
+        if fill_all:
+            fill = not edge[c]
+        else:
+            size = outer if edge[c] else starts[c+1]-starts[c]
+            fill = size <= thresh if inclusive else size < thresh
+        if not fill:
+            continue
+        conflict = conflict or edge[c]
+        for i in range(starts[c], starts[c+1]):
+            q = queue[i]
+            z, y, x = z0+q//PYX-1, y0+(q//PX)%PY-1, x0+q%PX-1
+            if masks[z,y,x]!=0:
+                conflict = True
+            if write:
+                holes[nh] = (z*Ly+y)*Lx+x
+            nh += 1
+    return nh, conflict
+
+
+@njit(parallel=True, cache=True)
+def _fill_holes_and_remove_small(masks, nlab, dims, min_size, hole_size, inclusive, fill_all):
+    """ In-place core of fill_holes_and_remove_small_masks for compact labels 1,...,nlab.
+    
+    The objects are independent unless a hole takes in other labels (or the outside of the box), 
+    so the holes are first found for every object in parallel from the original labels. If none 
+    of them conflict, the relabeling and hole filling are written in parallel too; otherwise the 
+    objects are processed one after the other like the original loop so that the result is the same. 
+    
+    """
+    Lz, Ly, Lx = masks.shape
+    
+    # one pass for the bounding boxes and areas 
+    bbox = np.empty((nlab+1,6), np.int64)
+    bbox[:,:3] = max(Lz,Ly,Lx)
+    bbox[:,3:] = 0
+    npix = np.zeros(nlab+1, np.int64)
+    for z in range(Lz):
+        for y in range(Ly):
+            for x in range(Lx):
+                l = masks[z,y,x]
+                if l>0:
+                    npix[l] += 1
+                    bbox[l,0] = min(bbox[l,0],z)
+                    bbox[l,1] = min(bbox[l,1],y)
+                    bbox[l,2] = min(bbox[l,2],x)
+                    bbox[l,3] = max(bbox[l,3],z+1)
+                    bbox[l,4] = max(bbox[l,4],y+1)
+                    bbox[l,5] = max(bbox[l,5],x+1)
+    
+    keep = np.zeros(nlab+1, np.bool_)
+    newlab = np.zeros(nlab+1, masks.dtype)
+    j = 0
+    for l in range(1,nlab+1):
+        if npix[l]>0 and not (min_size>0 and npix[l]<min_size):
+            keep[l] = True
+            j += 1
+            newlab[l] = j
+    
+    nh = np.zeros(nlab+1, np.int64)
+    conflict = np.zeros(nlab+1, np.bool_)
+    empty = np.empty(0, np.int64)
+    for l in prange(1,nlab+1):
+        if keep[l]:
+            nh[l], conflict[l] = _object_holes(masks, l, bbox[l], npix[l]*hole_size/100, inclusive,
+                                               fill_all, dims, empty, False)
+    
+    if not conflict.any():
+        offsets = np.zeros(nlab+2, np.int64)
+        offsets[1:] = np.cumsum(nh)
+        holes = np.empty(offsets[-1], np.int64)
+        for l in prange(1,nlab+1):
+            if nh[l]>0:
+                _object_holes(masks, l, bbox[l], npix[l]*hole_size/100, inclusive,
+                              fill_all, dims, holes[offsets[l]:offsets[l+1]], True)
+        for z in prange(Lz):
+            for y in range(Ly):
+                for x in range(Lx):
+                    masks[z,y,x] = newlab[masks[z,y,x]]
+        flat = masks.reshape(-1)
+        for l in prange(1,nlab+1):
+            for i in range(offsets[l],offsets[l+1]):
+                flat[holes[i]] = newlab[l]
+        return masks
+    
+    # the objects interact, so go in order on the live labels 
+    flat = masks.reshape(-1)
+    j = 0
+    for l in range(1,nlab+1):
+        if npix[l]==0:
+            continue 
+        b = bbox[l]
+        c = 0
+        for z in range(b[0],b[3]):
+            for y in range(b[1],b[4]):
+                for x in range(b[2],b[5]):
+                    c += masks[z,y,x]==l
+        if min_size>0 and c<min_size:
+            val = 0
+            k = 0
+            holes = empty
+        else:
+            holes = np.empty((b[3]-b[0])*(b[4]-b[1])*(b[5]-b[2]), np.int64)
+            k, _ = _object_holes(masks, l, b, c*hole_size/100, inclusive, fill_all, dims, holes, True)
+            j += 1
+            val = j
+        for z in range(b[0],b[3]):
+            for y in range(b[1],b[4]):
+                for x in range(b[2],b[5]):
+                    if masks[z,y,x]==l:
+                        masks[z,y,x] = val
+        for i in range(k):
+            flat[holes[i]] = val
+    return masks
+
+
 def fill_holes_and_remove_small_masks(masks, min_size=15, hole_size=3, scale_factor=1, dim=2):
     """ fill holes in masks (2D/3D) and discard masks smaller than min_size (2D)
     
@@ -1906,6 +2815,17 @@ def fill_holes_and_remove_small_masks(masks, min_size=15, hole_size=3, scale_fac
         
     hole_size *= scale_factor
     
+    if masks.ndim in (2,3):
+        # numba version of the loop below, all objects in one call
+        # (SKIMAGE_ENABLED: remove_small_holes with padding, otherwise binary_fill_holes)
+        masks = np.ascontiguousarray(masks)
+        nlab = int(masks.max()) if masks.size else 0
+        if nlab>0:
+            _fill_holes_and_remove_small(masks.reshape((1,)*(3-masks.ndim)+masks.shape), nlab, 
+                                         masks.ndim, min_size, float(hole_size), _HOLES_INCLUSIVE, 
+                                         not SKIMAGE_ENABLED)
+        return masks
+    
     slices = find_objects(masks)
     j = 0
     for i,slc in enumerate(slices):
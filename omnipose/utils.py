@@ -50,8 +50,7 @@ def normalize99(Y,lower=0.01,upper=99.99):
     normalized array with a minimum of 0 and maximum of 1
     
     """
-    X = Y.copy()
-    return np.interp(X, (np.percentile(X, lower), np.percentile(X, upper)), (0, 1))
+    return np.interp(Y, np.percentile(Y, (lower, upper)), (0, 1))
 
 def normalize_image(im,mask,bg=0.5,dim=2):
     """ Normalize image by rescaling from 0 to 1 and then adjusting gamma to bring 
@@ -224,6 +223,28 @@ def get_boundary(mask):
     """
     return np.logical_xor(mask,mh.morph.erode(mask))
 
+def get_border_mask(shape, width=1):
+    """Boolean mask of all pixels within a given distance of the array edges. 
+    
+    Same as dilating an empty mask with border_value=1 for <width> iterations, 
+    but built directly by clearing the interior. 
+    
+    Parameters
+    ----------
+    shape: tuple, int
+        shape of the array
+    width: int
+        thickness of the border in pixels
+    
+    Returns
+    --------------
+    ND array, bool
+    
+    """
+    border_mask = np.ones(shape, dtype=bool)
+    border_mask[tuple([slice(width,s-width) for s in shape])] = False
+    return border_mask
+
 # Kevin's version of remove_edge_masks, need to merge (this one is more flexible)
 def clean_boundary(labels, boundary_thickness=3, area_thresh=30, dists=None):
     """Delete boundary masks below a given size threshold within a certain distance from the boundary. 
@@ -241,8 +262,7 @@ def clean_boundary(labels, boundary_thickness=3, area_thresh=30, dists=None):
     label matrix with small edge labels removed. 
     
     """
-    border_mask = np.zeros(labels.shape, dtype=bool)
-    border_mask = binary_dilation(border_mask, border_value=1, iterations=boundary_thickness)
+    border_mask = get_border_mask(labels.shape, boundary_thickness)
     clean_labels = np.copy(labels)
     # bddist = dists[border_mask]
     # dist_thresh = np.mean(bddist[bddist>0])
@@ -280,8 +300,7 @@ def get_edge_masks(labels,dists):
         label matrix of all cells qualifying as 'edge masks'
     
     """
-    border_mask = np.zeros(labels.shape, dtype=bool)
-    border_mask = binary_dilation(border_mask, border_value=1, iterations=1)
+    border_mask = get_border_mask(labels.shape, 1)
     clean_labels = np.zeros_like(labels)
     
     for cell_ID in fastremap.unique(labels[border_mask])[1:]:
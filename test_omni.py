@@ -1,5 +1,6 @@
 import pytest
 import os
+import numpy as np
 from pathlib import Path
 import skimage.io
 import omnipose
@@ -8,3 +9,202 @@ def test_omni():
     basedir = Path(os.path.dirname(omnipose.__file__)).parent.absolute()
     # masks = skimage.io.imread(os.path.join(masks_dir,'example.png'))
     
+
+
+def _get_masks_reference(p, rpad=20):
+    """ Original list-based get_masks_cp: seeds in raster order, grown 5 times into pixels
+        with h>2 and written one after the other (later seeds win overlaps). """
+    from scipy.ndimage import maximum_filter1d
+    shape0 = p.shape[1:]
+    dims = len(p)
+    pflows = [p[i].flatten().astype('int32') for i in range(dims)]
+    edges = [np.arange(-.5-rpad, shape0[i]+.5+rpad, 1) for i in range(dims)]
+    h,_ = np.histogramdd(pflows, bins=edges)
+    hmax = h.copy()
+    for i in range(dims):
+        hmax = maximum_filter1d(hmax, 5, axis=i)
+    seeds = np.nonzero(np.logical_and(h-hmax>-1e-6, h>10))
+    expand = np.array(np.nonzero(np.ones((3,)*dims)))-1
+    M = np.zeros(h.shape, np.int32)
+    for k, seed in enumerate(np.array(seeds).T):
+        pix = seed[:,None]
+        for it in range(5):
+            pix = (pix[:,:,None]+expand[:,None,:]).reshape(dims,-1)
+            pix = pix[:, h[tuple(pix)]>2]
+        M[tuple(pix)] = k+1
+    M0 = M[tuple([pf+rpad for pf in pflows])]
+    _,counts = np.unique(M0, return_counts=True)
+    for i in np.nonzero(counts > np.prod(shape0)*0.4)[0]:
+        M0[M0==i] = 0
+    return np.reshape(np.unique(M0, return_inverse=True)[1], shape0)
+
+
+def _same_partition(a, b):
+    pairs = np.unique(np.stack([a.ravel(), b.ravel()]), axis=1)
+    return pairs.shape[1] == len(np.unique(a)) == len(np.unique(b))
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_get_masks_cp_partition(seed):
+    """ Pixels converging on nearby points make neighboring seeds overlap when grown. """
+    from omnipose.core import get_masks_cp
+    rng = np.random.default_rng(seed)
+    shape = (120,130)
+    p = np.stack(np.meshgrid(*[np.arange(s) for s in shape], indexing='ij')).astype(np.float32)
+    for c in rng.uniform(10, 110, size=(25,2)):
+        inside = np.sum((p-c[:,None,None])**2, axis=0) < rng.uniform(25, 150)
+        # two sinks of unequal size a few pixels apart
+        a = rng.uniform(0, 2*np.pi)
+        sinks = np.stack([c, c + rng.uniform(3.5, 7)*np.array([np.cos(a), np.sin(a)])])
+        which = rng.random(inside.sum()) < rng.uniform(0.2, 0.5)
+        pts = sinks[which.astype(int)].T + rng.normal(0, 1.2, size=(2,inside.sum()))
+        p[:,inside] = pts.clip(0, np.array(shape)[:,None]-1)
+    ref = _get_masks_reference(p.copy())
+    new = get_masks_cp(p.copy())
+    assert ref.max() > 0
+    assert _same_partition(ref, new)
+
+
+@pytest.mark.parametrize('omni', [True, False])
+@pytest.mark.parametrize('shape,ncell', [((96,100),3), ((64,70),40), ((24,26,28),4)])
+def test_extend_centers_paths_agree(monkeypatch, omni, shape, ncell):
+    """ The gathered (sparse) and shifted-view (dense) diffusion give the same flows. """
+    import torch
+    from omnipose import core
+    rng = np.random.default_rng(0)
+    masks = np.zeros(shape, np.int32)
+    grid = np.indices(shape)
+    for k, c in enumerate(rng.uniform(5, np.array(shape)-5, size=(ncell,len(shape)))):
+        r2 = np.sum((grid-c.reshape((-1,)+(1,)*len(shape)))**2, axis=0)
+        masks[(r2 < rng.uniform(9, 40)) & (masks==0)] = k+1
+    masks = np.unique(masks, return_inverse=True)[1].reshape(shape).astype(np.int32)
+    out = []
+    for fill in [np.inf, 0]:
+        monkeypatch.setattr(core, 'DENSE_FILL', fill)
+        out.append(core.masks_to_flows_torch(masks, dists=core.edt.edt(masks),
+                                             device=torch.device('cpu'), omni=omni))
+    assert np.allclose(out[0][0], out[1][0], atol=1e-4)
+    assert np.allclose(out[0][1], out[1][1], atol=1e-4)
+
+
+@pytest.mark.parametrize('omni', [True, False])
+def test_extend_centers_cuda_graph(monkeypatch, omni):
+    """ Replaying the captured CUDA graph matches the plain loop. """
+    import torch
+    if not torch.cuda.is_available():
+        pytest.skip('needs CUDA')
+    from omnipose import core
+    masks = np.zeros((2,60,64), np.int32)
+    masks[0,10:30,12:40] = 1
+    masks[0,35:55,20:50] = 2
+    masks[1,5:50,30:60] = 1
+    out = []
+    for graph in [False, True]:
+        monkeypatch.setattr(core, 'CUDA_GRAPH', graph)
+        out.append(core.masks_to_flows_torch(masks, dists=np.stack([core.edt.edt(m) for m in masks]),
+                                             device=torch.device('cuda'), omni=omni, batch=True))
+    assert np.allclose(out[0][0], out[1][0], atol=1e-5)
+    assert np.allclose(out[0][1].cpu().numpy(), out[1][1].cpu().numpy(), atol=1e-5)
+
+
+def test_labels_to_flows_pool(monkeypatch):
+    """ Flows computed in the process pool match computing them one image at a time. """
+    from omnipose import core
+    monkeypatch.setattr(os, 'cpu_count', lambda: 2) # use the pool even on a single core
+    rng = np.random.default_rng(0)
+    labels = []
+    for n in range(3):
+        m = np.zeros((60,70), np.int32)
+        for k in range(4):
+            y, x = rng.integers(5, 45), rng.integers(5, 55)
+            m[y:y+rng.integers(6,14), x:x+rng.integers(6,14)] = k+1
+        labels.append(m)
+    flows = core.labels_to_flows(labels)
+    for m, flow in zip(labels, flows):
+        ref = core.masks_to_flows(m)
+        assert np.array_equal(flow[0], ref[0])
+        assert np.allclose(flow[1], ref[1])
+        assert np.allclose(flow[2:4], ref[3], atol=1e-5)
+        assert np.allclose(flow[4], ref[2], atol=1e-5)
+
+
+def test_do_warp_batch_torch():
+    """ The batched torch warp matches warping (and flipping) each image with do_warp. """
+    import torch
+    from omnipose.core import do_warp, do_warp_batch_torch
+    rng = np.random.default_rng(0)
+    tyx = (48,56)
+    X, warps, ref = [], [], []
+    for n, size in enumerate([(60,70), (40,90), (52,52)]):
+        # smooth images, so that cv2's fixed-point interpolation weights barely matter 
+        grid = np.indices(size)
+        x = np.stack([np.sin(grid[0]/(5+k)+grid[1]/(7+k)) for k in range(2)]).astype(np.float32)
+        theta, s = rng.uniform(0, 2*np.pi), rng.uniform(0.7, 1.4)
+        M = s*np.array([[np.cos(theta), -np.sin(theta)], [np.sin(theta), np.cos(theta)]])
+        offset = (np.array(size)-1)/2 - np.linalg.inv(M) @ ((np.array(tyx)-1)/2) + rng.uniform(-10, 10, 2)
+        flips = [[], [1], [1,2]][n]
+        r = do_warp(x, M, tyx, offset=offset, mode='reflect')
+        if len(flips):
+            r = np.flip(r, axis=tuple([-d for d in flips]))
+        X.append(x)
+        warps.append((M, offset, flips))
+        ref.append(r)
+    out = do_warp_batch_torch(X, warps, tyx, 2, torch.device('cpu')).numpy()
+    assert out.shape == (3,2)+tyx
+    assert np.abs(out-np.stack(ref)).max() < 0.01
+
+
+def _fill_holes_reference(masks, min_size, hole_size, skimage_enabled):
+    """ Original per-object loop of fill_holes_and_remove_small_masks. """
+    import ncolor
+    from scipy.ndimage import find_objects, binary_fill_holes
+    from skimage.morphology import remove_small_holes
+    masks = ncolor.format_labels(masks, min_area=min_size)
+    j = 0
+    for i, slc in enumerate(find_objects(masks)):
+        if slc is not None:
+            msk = masks[slc] == (i+1)
+            if min_size > 0 and msk.sum() < min_size:
+                masks[slc][msk] = 0
+            else:
+                if skimage_enabled:
+                    unpad = tuple([slice(1,-1)]*msk.ndim)
+                    msk = remove_small_holes(np.pad(msk,1,mode='constant'), np.count_nonzero(msk)*hole_size/100)[unpad]
+                else:
+                    msk = binary_fill_holes(msk)
+                masks[slc][msk] = (j+1)
+                j += 1
+    return masks
+
+
+@pytest.mark.parametrize('skimage_enabled', [True, False])
+@pytest.mark.parametrize('shape,ncell', [((200,220),80), ((30,40,50),30)])
+def test_fill_holes_and_remove_small_masks(monkeypatch, skimage_enabled, shape, ncell):
+    """ The numba hole filling matches the per-object skimage/scipy loop it replaces. """
+    from omnipose import core
+    monkeypatch.setattr(core, 'SKIMAGE_ENABLED', skimage_enabled)
+    rng = np.random.default_rng(1)
+    masks = np.zeros(shape, np.int32)
+    grid = np.indices(shape)
+    for k in range(1, ncell+1):
+        c = rng.integers(0, shape).reshape((-1,)+(1,)*len(shape))
+        r2 = np.sum((grid-c)**2, axis=0)
+        rad = rng.integers(2, 14)
+        masks[r2 < rad**2] = k
+        if rng.random() < 0.6: # punch a hole, sometimes with another label in it
+            masks[r2 < (rad//3)**2] = 0 if rng.random() < 0.7 else rng.integers(0, ncell+1)
+    for min_size, hole_size in [(15,3), (-1,3), (50,30), (15,200)]:
+        ref = _fill_holes_reference(masks.copy(), min_size, hole_size, skimage_enabled)
+        out = core.fill_holes_and_remove_small_masks(masks.copy(), min_size=min_size, hole_size=hole_size)
+        assert np.array_equal(out, ref)
+
+
+def test_fill_holes_threshold_size():
+    """ A hole exactly at the threshold is treated the same way as by the installed skimage. """
+    from omnipose import core
+    masks = np.zeros((20,20), np.int32)
+    masks[4:15,5:15] = 1 # 110 pixels
+    masks[7:9,7:12] = 0 # 10 pixel hole, so 100 object pixels and hole_size=10 puts the threshold at 10
+    ref = _fill_holes_reference(masks.copy(), 15, 10, True)
+    out = core.fill_holes_and_remove_small_masks(masks.copy(), min_size=15, hole_size=10)
+    assert np.array_equal(out, ref)